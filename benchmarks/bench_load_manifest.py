@@ -0,0 +1,97 @@
+"""
+Compares loading several datasets with one `load-dataset` process per file against a single
+`load-manifest` run.
+
+Run from the repository root with mtools installed (`pip install -e .`):
+
+    python benchmarks/bench_load_manifest.py [--files N] [--instances N]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+CONFIG = '''[mturk]
+region_name = us-east-1
+
+[database]
+url = sqlite:///{database}
+
+[logging]
+logfile = {logfile}
+'''
+
+EVAL_TYPES = ['left', 'right', 'no_context']
+
+
+def write_dataset(filename, num_instances, offset):
+    with open(filename, 'w') as f:
+        for i in range(offset, offset + num_instances):
+            f.write(json.dumps({
+                'sentence_good': f'The cat sat on mat number {i}.',
+                'sentence_bad': f'The cat sat mat on number {i}.',
+                'left_context': 'Once upon a time.',
+                'right_context': 'The end.',
+            }))
+            f.write('\n')
+
+
+def run(workdir, database, *args):
+    """
+    Runs `mtools-cli` against a fresh database in `workdir`, returning the wall time and the peak
+    RSS in MB of the largest process (a command, or one of its worker processes).
+    """
+    config = os.path.join(workdir, f'{database}.ini')
+    with open(config, 'w') as f:
+        f.write(CONFIG.format(
+            database=os.path.join(workdir, f'{database}.db'),
+            logfile=os.path.join(workdir, f'{database}.log')
+        ))
+    env = dict(os.environ, MTOOLS_CONFIG=config)
+    command = [sys.executable, '-m', 'mtools.cli']
+    subprocess.run(command + ['init-db'], env=env, stdout=subprocess.DEVNULL, check=True)
+    start = time.perf_counter()
+    peak = 0
+    for arguments in args:
+        process = subprocess.Popen(command + arguments, env=env, stdout=subprocess.DEVNULL)
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+        peak = max(peak, usage.ru_maxrss / 1024)
+    return time.perf_counter() - start, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=5)
+    parser.add_argument('--instances', type=int, default=100000, help='Instances per file.')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='mtools-bench-')
+    entries = []
+    for i in range(args.files):
+        filename = os.path.join(workdir, f'dataset_{i}.jsonl')
+        write_dataset(filename, args.instances, offset=i * args.instances)
+        entries.append({'filename': filename, 'eval_type': EVAL_TYPES[i % len(EVAL_TYPES)]})
+    manifest = os.path.join(workdir, 'manifest.json')
+    with open(manifest, 'w') as f:
+        json.dump(entries, f)
+
+    total = args.files * args.instances
+    separate, separate_peak = run(workdir, 'separate', *[
+        ['load-dataset', '-e', entry['eval_type'], entry['filename']] for entry in entries
+    ])
+    combined, combined_peak = run(workdir, 'manifest', ['load-manifest', manifest])
+    print(f'{"method":<24} {"seconds":>9} {"rows/sec":>10} {"peak MB":>8}')
+    print(f'{"load-dataset per file":<24} {separate:9.2f} {total / separate:10.0f} {separate_peak:8.0f}')
+    print(f'{"load-manifest":<24} {combined:9.2f} {total / combined:10.0f} {combined_peak:8.0f}')
+    print(f'Working directory: {workdir}')
+
+
+if __name__ == '__main__':
+    main()
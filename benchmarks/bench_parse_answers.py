@@ -0,0 +1,68 @@
+"""
+Compares the expat answer parser against the original ElementTree implementation.
+
+Run from the repository root with mtools installed (`pip install -e .`):
+
+    python benchmarks/bench_parse_answers.py [--assignments N] [--questions N]
+"""
+import argparse
+import random
+import time
+import xml.etree.ElementTree as xml
+
+from mtools.evaluate import NAMESPACE, parse_answers
+
+
+def parse_answer_xml_etree(answer_xml):
+    # The original implementation, kept here as a reference.
+    root = xml.fromstring(answer_xml)
+    answers = root.findall('mturk:Answer', NAMESPACE)
+    results = []
+    for answer in answers:
+        question_key = answer.find('mturk:QuestionIdentifier', NAMESPACE)
+        selected = answer.find('mturk:SelectionIdentifier', NAMESPACE)
+        results.append((int(question_key.text), selected.text))
+    return results
+
+
+def make_answer_xml(num_questions, rng, indent=None):
+    """A compact answer blob, or one pretty-printed with `indent` if given."""
+    newline = '' if indent is None else '\n'
+    pad = '' if indent is None else indent
+    answers = ''.join(
+        f'{newline}{pad}<Answer>'
+        f'{newline}{pad * 2}<QuestionIdentifier>{rng.randrange(10 ** 6)}</QuestionIdentifier>'
+        f'{newline}{pad * 2}<SelectionIdentifier>{rng.choice("ab")}</SelectionIdentifier>'
+        f'{newline}{pad}</Answer>'
+        for _ in range(num_questions)
+    )
+    return (
+        f'<?xml version="1.0" encoding="ASCII"?>{newline}'
+        f'<QuestionFormAnswers xmlns="{NAMESPACE["mturk"]}">{answers}{newline}</QuestionFormAnswers>'
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--assignments', type=int, default=10000)
+    parser.add_argument('--questions', type=int, default=20)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    blobs = [make_answer_xml(args.questions, rng) for _ in range(args.assignments)]
+    # Check the parsers agree on compact as well as indented XML.
+    checks = blobs[:100] + [make_answer_xml(args.questions, rng, indent) for indent in ('  ', '\t', '') * 10]
+    for blob in checks:
+        answers, errors = parse_answers(blob)
+        assert answers == parse_answer_xml_etree(blob) and not errors, 'Parsers disagree'
+
+    for name, parse in (('etree', parse_answer_xml_etree), ('expat', parse_answers)):
+        start = time.perf_counter()
+        for blob in blobs:
+            parse(blob)
+        elapsed = time.perf_counter() - start
+        print(f'{name:>6}: {1e6 * elapsed / len(blobs):8.1f} us/assignment ({len(blobs)} assignments)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""
+End-to-end benchmark of the mtools hot paths against an in-process fake of MTurk.
+
+Loads a synthetic dataset, deploys HITs, syncs, evaluates and exports the (simulated) assignments,
+approves them, and expires and deletes the HITs, reporting wall time, API calls, DB queries and
+peak Python memory for each stage.
+
+Run from the repository root with mtools installed (`pip install -e .`):
+
+    python benchmarks/bench_pipeline.py [--instances N] [--hits N] [--latency SECONDS] [--json FILE]
+
+With `--api-rps`, the fake throttles calls above that rate, and every stage that can limit its own
+calls is given `--max-rps` at the same rate. Other calls are retried as botocore would.
+"""
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+import tracemalloc
+
+from fake_mturk import FakeMTurk
+
+
+TEMPLATES = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'templates')
+
+CONFIG = '''[mturk]
+region_name = us-east-1
+
+[database]
+url = sqlite:///{database}
+
+[logging]
+logfile = {logfile}
+'''
+
+
+def write_dataset(filename, num_instances, offset):
+    with open(filename, 'w') as f:
+        for i in range(offset, offset + num_instances):
+            f.write(json.dumps({
+                'sentence_good': f'The cat sat on mat number {i}.',
+                'sentence_bad': f'The cat sat mat on number {i}.',
+                'left_context': 'Once upon a time.',
+                'right_context': 'The end.',
+            }))
+            f.write('\n')
+
+
+class Stages:
+    """Runs named stages, recording wall time, API calls, DB queries and peak memory of each."""
+    def __init__(self, fake, engine, trace_memory):
+        from sqlalchemy import event
+
+        self.fake = fake
+        self.trace_memory = trace_memory
+        self.queries = 0
+        self.results = []
+        event.listen(engine, 'before_cursor_execute', self._count_query)
+
+    def _count_query(self, *args):
+        self.queries += 1
+
+    def run(self, name, command, args):
+        api_calls = sum(self.fake.calls.values())
+        throttled = sum(self.fake.throttled.values())
+        queries = self.queries
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        command.main(args=args, standalone_mode=False)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if self.trace_memory else None
+        self.results.append({
+            'stage': name,
+            'seconds': elapsed,
+            'api_calls': sum(self.fake.calls.values()) - api_calls,
+            'throttled': sum(self.fake.throttled.values()) - throttled,
+            'db_queries': self.queries - queries,
+            'peak_mb': peak / 2 ** 20 if peak is not None else None,
+        })
+
+    def report(self):
+        print(
+            f'{"stage":<18} {"seconds":>9} {"api calls":>10} {"throttled":>10} '
+            f'{"db queries":>11} {"peak MB":>8}'
+        )
+        for r in self.results:
+            peak = f'{r["peak_mb"]:8.1f}' if r['peak_mb'] is not None else f'{"-":>8}'
+            print(
+                f'{r["stage"]:<18} {r["seconds"]:9.2f} {r["api_calls"]:10d} {r["throttled"]:10d} '
+                f'{r["db_queries"]:11d} {peak}'
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--instances', type=int, default=10000, help='Instances per dataset.')
+    parser.add_argument('--datasets', type=int, default=2)
+    parser.add_argument('--hits', type=int, default=200)
+    parser.add_argument('--questions-per-hit', type=int, default=20)
+    parser.add_argument('--max-assignments', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--processes', type=int, default=1, help='Processes rendering HITs in deploy.')
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds per fake API call.')
+    parser.add_argument('--api-rps', type=float, default=None, help='Fake API throttles above this rate.')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='Skip tracemalloc, which slows every stage.')
+    parser.add_argument('--json', type=str, default=None, help='Also write results to this file.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    workdir = tempfile.mkdtemp(prefix='mtools-bench-')
+    config_filename = os.path.join(workdir, 'config.ini')
+    with open(config_filename, 'w') as f:
+        f.write(CONFIG.format(
+            database=os.path.join(workdir, 'bench.db'),
+            logfile=os.path.join(workdir, 'bench.log')
+        ))
+    os.environ['MTOOLS_CONFIG'] = config_filename
+
+    import mtools.client
+    from mtools.client import DEFAULT_MAX_ATTEMPTS
+    from mtools.db import get_engine, init_db, session_scope, HitType, Question
+    from mtools.deploy import deploy
+    from mtools.evaluate import evaluate
+    from mtools.export import export_results
+    from mtools.io import load_dataset
+    from mtools.lifecycle import delete_hits, expire_hits
+    from mtools.mturk import accept_all
+    from mtools.sync import sync_assignments
+
+    fake = FakeMTurk(latency=args.latency, max_rps=args.api_rps, max_attempts=DEFAULT_MAX_ATTEMPTS)
+    mtools.client._client = fake
+    mtools.client._limited_client = fake.without_retries()
+    init_db.main(args=[], standalone_mode=False)
+    with session_scope() as session:
+        session.add(HitType(short_name='bench', hit_type_id='FAKEHITTYPE'))
+
+    if not args.no_memory:
+        tracemalloc.start()
+    stages = Stages(fake, get_engine(), trace_memory=not args.no_memory)
+    for i in range(args.datasets):
+        filename = os.path.join(workdir, f'dataset_{i}.jsonl')
+        write_dataset(filename, args.instances, offset=i * args.instances)
+        stages.run(f'load-dataset {i}', load_dataset, [filename, '-e', ('left', 'right', 'no_context')[i % 3]])
+
+    # Options passed to every stage that limits its own API calls.
+    pacing = ['--workers', str(args.workers)]
+    if args.api_rps:
+        pacing += ['--max-rps', str(args.api_rps)]
+
+    stages.run('deploy', deploy, [
+        'bench',
+        '-n', str(args.hits),
+        '-q', str(args.questions_per_hit),
+        '--max_assignments', str(args.max_assignments),
+        '--overview_filename', os.path.join(TEMPLATES, 'overview.json'),
+        *pacing,
+        '--processes', str(args.processes),
+        '--batch', os.path.join(workdir, 'batch.jsonl'),
+        '--seed', '0',
+    ])
+    with session_scope() as session:
+        fake.gold.update(session.query(Question.key, Question.answer))
+
+    results = os.path.join(workdir, 'results')
+    stages.run('evaluate (api)', evaluate, ['bench', '-o', results, '--bootstrap', '50'])
+    stages.run('sync-assignments', sync_assignments, ['bench', '--workers', str(args.workers)])
+    stages.run('evaluate (local)', evaluate, ['bench', '--local', '-o', results, '--bootstrap', '50'])
+    stages.run('export-results', export_results, [os.path.join(workdir, 'responses')])
+    stages.run('accept-all', accept_all, pacing)
+    stages.run('accept-all (again)', accept_all, pacing)
+    stages.run('expire-hits', expire_hits, ['bench', *pacing])
+    stages.run('delete-hits', delete_hits, ['bench', *pacing])
+
+    stages.report()
+    print(f'Working directory: {workdir}')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'stages': stages.results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
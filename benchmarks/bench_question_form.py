@@ -0,0 +1,63 @@
+"""
+Compares the ElementTree and template QuestionForm renderers.
+
+Run from the repository root with mtools installed (`pip install -e .`):
+
+    python benchmarks/bench_question_form.py [--repeat N]
+"""
+import argparse
+import json
+import random
+import timeit
+
+from mtools.question_form import QuestionForm, TemplateQuestionForm
+
+
+def make_choices(n, rng):
+    words = ['the', 'cat', 'sat', 'on', 'a', 'mat', '&', '<b>', 'said', '"hi"', 'über']
+    return [
+        [' '.join(rng.choice(words) for _ in range(20)) for _ in range(2)]
+        for _ in range(n)
+    ]
+
+
+def render(form_class, overview, questions):
+    question_form = form_class()
+    question_form.add_overview(**overview)
+    for i, choices in enumerate(questions):
+        question_form.add_multiple_choice_question(question_identifier=str(i), choices=choices)
+    return question_form.tostring()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--overview', default='templates/overview.json')
+    args = parser.parse_args()
+
+    with open(args.overview, 'r') as f:
+        overview = json.load(f)
+    rng = random.Random(0)
+
+    print(f'{"questions":>10} {"etree (ms)":>12} {"template (ms)":>14} {"speedup":>8} {"bytes":>8}')
+    for n in (10, 50, 200):
+        questions = make_choices(n, rng)
+        expected = render(QuestionForm, overview, questions)
+        actual = render(TemplateQuestionForm, overview, questions)
+        assert actual == expected, 'Renderers disagree'
+        times = {}
+        for form_class in (QuestionForm, TemplateQuestionForm):
+            elapsed = min(timeit.repeat(
+                lambda: render(form_class, overview, questions),
+                number=args.repeat,
+                repeat=3
+            ))
+            times[form_class] = 1000 * elapsed / args.repeat
+        print(
+            f'{n:>10} {times[QuestionForm]:>12.3f} {times[TemplateQuestionForm]:>14.3f} '
+            f'{times[QuestionForm] / times[TemplateQuestionForm]:>7.1f}x {len(expected.encode("utf-8")):>8}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Measures `mtools-cli` startup time, and which heavy dependencies each command imports.
+
+Run from the repository root with mtools installed (`pip install -e .`):
+
+    python benchmarks/bench_startup.py [--runs N]
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+
+INVOCATIONS = [
+    ['--help'],
+    ['load-dataset', '--help'],
+    ['deploy', '--help'],
+    ['evaluate', '--help'],
+]
+
+HEAVY_MODULES = ['boto3', 'botocore', 'sqlalchemy', 'numpy']
+
+PROBE = '''
+import sys
+from mtools.cli import cli
+try:
+    cli.main(args=sys.argv[1:], standalone_mode=False)
+except SystemExit:
+    pass
+print(' '.join(m for m in {modules!r} if m in sys.modules), file=sys.stderr)
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    probe = PROBE.format(modules=HEAVY_MODULES)
+    print(f'{"command":<28} {"median (ms)":>12} {"min (ms)":>10}  imported')
+    for invocation in INVOCATIONS:
+        times = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            result = subprocess.run(
+                [sys.executable, '-c', probe, *invocation],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                text=True,
+                check=True
+            )
+            times.append(1000 * (time.perf_counter() - start))
+        imported = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else ''
+        print(
+            f'{" ".join(invocation):<28} {statistics.median(times):>12.1f} {min(times):>10.1f}  {imported}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+"""
+An in-process stand-in for the MTurk requester API, for benchmarks.
+
+Implements the client methods mtools uses, with configurable per-call latency and a request rate
+above which calls are throttled. Throttled calls are retried with backoff up to `max_attempts`
+times in all, as botocore's retry handler does for the real client, before the ThrottlingException
+reaches the caller. HITs get `MaxAssignments` submitted assignments, generated the
+first time they are looked up by simulated workers who pick the gold answer with some probability.
+"""
+from collections import Counter
+import copy
+import datetime
+import itertools
+import random
+import re
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+
+QUESTION_IDENTIFIER = re.compile(r'<QuestionIdentifier>(\d+)</QuestionIdentifier>')
+ANSWER_NAMESPACE = (
+    'http://mechanicalturk.amazonaws.com/AWSMechanicalTurkDataSchemas/2005-10-01/QuestionFormAnswers.xsd'
+)
+
+
+class _Meta:
+    class config:
+        max_pool_connections = 1000
+
+
+class _Paginator:
+    def __init__(self, pages):
+        self.pages = pages
+
+    def paginate(self, **kwargs):
+        return self.pages(**kwargs)
+
+
+class FakeMTurk:
+    def __init__(self, latency=0.0, max_rps=None, max_attempts=1, num_workers=50, seed=0):
+        self.latency = latency
+        self.max_rps = max_rps
+        self.max_attempts = max_attempts
+        self.meta = _Meta()
+        self.calls = Counter()
+        self.throttled = Counter()
+        self.gold = {}
+        self._rng = random.Random(seed)
+        self._workers = [(f'WORKER{i:04d}', self._rng.uniform(0.6, 0.95)) for i in range(num_workers)]
+        self._hits = {}
+        self._tokens = {}
+        self._assignments = {}
+        self._hit_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._window = []
+
+    def without_retries(self):
+        """
+        A view of the same fake that raises every throttle, like the limited client mtools paces
+        with a TokenBucket (`mtools.client.get_limited_client`).
+        """
+        view = copy.copy(self)
+        view.max_attempts = 1
+        return view
+
+    def _call(self, operation):
+        for attempt in range(self.max_attempts):
+            with self._lock:
+                self.calls[operation] += 1
+                throttled = self._throttle()
+                if throttled:
+                    self.throttled[operation] += 1
+            if not throttled:
+                break
+            if attempt == self.max_attempts - 1:
+                raise ClientError(
+                    {'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}},
+                    operation
+                )
+            # Full jitter exponential backoff, as in botocore's standard retry mode.
+            time.sleep(random.uniform(0, min(2 ** attempt, 20)))
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _throttle(self):
+        # Called with the lock held. Whether a call now would exceed max_rps in a one second window.
+        if self.max_rps is None:
+            return False
+        now = time.monotonic()
+        self._window[:] = [t for t in self._window if now - t < 1.0]
+        if len(self._window) >= self.max_rps:
+            return True
+        self._window.append(now)
+        return False
+
+    def _generate_assignments(self, hit):
+        # Called with the lock held. Tops the HIT up to MaxAssignments, e.g. after it was extended.
+        if hit['assignments'] is None:
+            hit['assignments'] = []
+        done = {assignment['WorkerId'] for assignment in hit['assignments']}
+        available = [worker for worker in self._workers if worker[0] not in done]
+        missing = min(hit['MaxAssignments'] - len(hit['assignments']), len(available))
+        for worker_id, skill in self._rng.sample(available, max(missing, 0)):
+            answers = []
+            for key in hit['question_keys']:
+                gold = self.gold.get(key, 'a')
+                wrong = 'b' if gold == 'a' else 'a'
+                answers.append(
+                    f'<Answer><QuestionIdentifier>{key}</QuestionIdentifier>'
+                    f'<SelectionIdentifier>{gold if self._rng.random() < skill else wrong}'
+                    '</SelectionIdentifier></Answer>'
+                )
+            accept_time = datetime.datetime.now(datetime.timezone.utc)
+            assignment = {
+                'AssignmentId': f'{hit["HITId"]}-{worker_id}',
+                'WorkerId': worker_id,
+                'HITId': hit['HITId'],
+                'AssignmentStatus': 'Submitted',
+                'AcceptTime': accept_time,
+                'SubmitTime': accept_time + datetime.timedelta(seconds=10 * len(answers)),
+                'Answer': (
+                    f'<QuestionFormAnswers xmlns="{ANSWER_NAMESPACE}">{"".join(answers)}</QuestionFormAnswers>'
+                ),
+            }
+            hit['assignments'].append(assignment)
+            self._assignments[assignment['AssignmentId']] = assignment
+
+    def create_hit_with_hit_type(self, HITTypeId, MaxAssignments, LifetimeInSeconds, Question,
+                                 UniqueRequestToken=None, RequesterAnnotation=None, **kwargs):
+        self._call('CreateHITWithHITType')
+        with self._lock:
+            if UniqueRequestToken is not None and UniqueRequestToken in self._tokens:
+                raise ClientError(
+                    {'Error': {
+                        'Code': 'RequestError',
+                        'Message': f'The UniqueRequestToken {UniqueRequestToken} has already been used.',
+                    }},
+                    'CreateHITWithHITType'
+                )
+            hit_id = f'FAKEHIT{next(self._hit_ids):023d}'
+            self._hits[hit_id] = {
+                'HITId': hit_id,
+                'HITTypeId': HITTypeId,
+                'MaxAssignments': MaxAssignments,
+                'RequesterAnnotation': RequesterAnnotation,
+                'Expiration': (
+                    datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=LifetimeInSeconds)
+                ),
+                'question_keys': [int(x) for x in QUESTION_IDENTIFIER.findall(Question)],
+                'assignments': None,
+            }
+            if UniqueRequestToken is not None:
+                self._tokens[UniqueRequestToken] = hit_id
+        return {'HIT': self._describe(self._hits[hit_id])}
+
+    def _describe(self, hit):
+        return {
+            key: hit[key] for key in ('HITId', 'HITTypeId', 'MaxAssignments', 'RequesterAnnotation', 'Expiration')
+        }
+
+    def _hit(self, HITId, operation):
+        # Called with the lock held.
+        if HITId not in self._hits:
+            raise ClientError(
+                {'Error': {'Code': 'RequestError', 'Message': f'Hit {HITId} does not exist.'}},
+                operation
+            )
+        return self._hits[HITId]
+
+    def get_hit(self, HITId):
+        self._call('GetHIT')
+        with self._lock:
+            hit = self._hit(HITId, 'GetHIT')
+            self._generate_assignments(hit)
+            statuses = Counter(x['AssignmentStatus'] for x in hit['assignments'])
+            return {'HIT': dict(
+                self._describe(hit),
+                NumberOfAssignmentsPending=0,
+                NumberOfAssignmentsAvailable=hit['MaxAssignments'] - len(hit['assignments']),
+                NumberOfAssignmentsCompleted=statuses['Approved'] + statuses['Rejected'],
+            )}
+
+    def list_assignments_for_hit(self, HITId, MaxResults=10, AssignmentStatuses=None, NextToken=None):
+        self._call('ListAssignmentsForHIT')
+        with self._lock:
+            hit = self._hits[HITId]
+            self._generate_assignments(hit)
+            assignments = [
+                dict(x) for x in hit['assignments']
+                if AssignmentStatuses is None or x['AssignmentStatus'] in AssignmentStatuses
+            ]
+        start = int(NextToken or 0)
+        response = {'Assignments': assignments[start:start + MaxResults]}
+        if start + MaxResults < len(assignments):
+            response['NextToken'] = str(start + MaxResults)
+        return response
+
+    def create_additional_assignments_for_hit(self, HITId, NumberOfAdditionalAssignments,
+                                              UniqueRequestToken=None):
+        self._call('CreateAdditionalAssignmentsForHIT')
+        with self._lock:
+            if UniqueRequestToken is not None and UniqueRequestToken in self._tokens:
+                raise ClientError(
+                    {'Error': {
+                        'Code': 'RequestError',
+                        'Message': f'The UniqueRequestToken {UniqueRequestToken} has already been used.',
+                    }},
+                    'CreateAdditionalAssignmentsForHIT'
+                )
+            self._hits[HITId]['MaxAssignments'] += NumberOfAdditionalAssignments
+            if UniqueRequestToken is not None:
+                self._tokens[UniqueRequestToken] = HITId
+        return {}
+
+    def update_expiration_for_hit(self, HITId, ExpireAt):
+        self._call('UpdateExpirationForHIT')
+        with self._lock:
+            self._hit(HITId, 'UpdateExpirationForHIT')['Expiration'] = ExpireAt
+        return {}
+
+    def delete_hit(self, HITId):
+        self._call('DeleteHIT')
+        with self._lock:
+            hit = self._hit(HITId, 'DeleteHIT')
+            pending = any(x['AssignmentStatus'] == 'Submitted' for x in hit['assignments'] or [])
+            if hit['Expiration'] > datetime.datetime.now(datetime.timezone.utc) or pending:
+                raise ClientError(
+                    {'Error': {
+                        'Code': 'RequestError',
+                        'Message': 'This HIT is currently in a state that does not allow deletion.',
+                    }},
+                    'DeleteHIT'
+                )
+            del self._hits[HITId]
+        return {}
+
+    def approve_assignment(self, AssignmentId, **kwargs):
+        self._call('ApproveAssignment')
+        with self._lock:
+            self._assignments[AssignmentId]['AssignmentStatus'] = 'Approved'
+            self._assignments[AssignmentId]['ApprovalTime'] = datetime.datetime.now(datetime.timezone.utc)
+        return {}
+
+    def _list_hits(self, **kwargs):
+        with self._lock:
+            hits = [self._describe(hit) for hit in self._hits.values()]
+        for i in range(0, len(hits), 100):
+            self._call('ListHITs')
+            yield {'HITs': hits[i:i + 100]}
+
+    def get_paginator(self, operation):
+        if operation == 'list_hits':
+            return _Paginator(self._list_hits)
+        raise NotImplementedError(operation)
@@ -3,23 +3,74 @@ The command-line interface.
 
 Defines `cli` to be used as a singleton in other scripts.
 """
+import importlib
 import logging
 import sys
 
 import click
 
-# TODO: Refactor so that we don't need to manually import all new commands...
-from mtools.config import config
-import mtools.db
-import mtools.deploy
-import mtools.io
-import mtools.evaluate
-import mtools.mturk
-
-
-@click.group()
+from mtools.config import get_config
+
+
+# Command name -> (module, attribute, short help). Modules are only imported when their command is
+# invoked, so that e.g. `load-dataset` doesn't pay for importing boto3 and `--help` imports nothing.
+COMMANDS = {
+    'init-db': ('mtools.db', 'init_db', 'Create the database tables.'),
+    'clear-db': ('mtools.db', 'clear_db', 'Drop the database tables.'),
+    'migrate-db': ('mtools.db', 'migrate_db', 'Bring an existing database up to date.'),
+    'deploy': ('mtools.deploy', 'deploy', 'Launch HITs (prepare, then publish).'),
+    'prepare': ('mtools.deploy', 'prepare', 'Reserve instances and render HITs into a batch file.'),
+    'publish': ('mtools.deploy', 'publish', 'Launch or resume the HITs in a batch file.'),
+    'recover-launches': ('mtools.journal', 'recover_launches', 'Reconcile pending launches with MTurk.'),
+    'expire-hits': ('mtools.lifecycle', 'expire_hits', 'Expire HITs so workers can no longer accept them.'),
+    'extend-hits': ('mtools.lifecycle', 'extend_hits', 'Extend the lifetime of HITs.'),
+    'delete-hits': ('mtools.lifecycle', 'delete_hits', 'Expire and delete HITs.'),
+    'evaluate': ('mtools.evaluate', 'evaluate', 'Score submitted assignments.'),
+    'export-results': ('mtools.export', 'export_results', 'Export stored responses to Parquet, Arrow or .npy.'),
+    'load-dataset': ('mtools.io', 'load_dataset', 'Load a JSONL dataset.'),
+    'load-manifest': ('mtools.io', 'load_manifest', 'Load every dataset listed in a manifest, in parallel.'),
+    'create-hittype': ('mtools.io', 'create_hittype', 'Create a HITType on MTurk.'),
+    'create-qualification': ('mtools.io', 'create_qualification', 'Create a QualificationType on MTurk.'),
+    'accept-all': ('mtools.mturk', 'accept_all', 'Approve all submitted assignments.'),
+    'sync-assignments': ('mtools.sync', 'sync_assignments', 'Download new assignments to the local store.'),
+    'schedule-assignments': ('mtools.schedule', 'schedule_assignments', 'Add assignments to ambiguous HITs.'),
+}
+
+
+class LazyGroup(click.Group):
+    """A group whose commands are imported from `COMMANDS` on first use."""
+    def list_commands(self, ctx):
+        return sorted(set(super().list_commands(ctx)) | set(COMMANDS))
+
+    def get_command(self, ctx, name):
+        if name in COMMANDS:
+            module, attribute, _ = COMMANDS[name]
+            return getattr(importlib.import_module(module), attribute)
+        return super().get_command(ctx, name)
+
+    def parse_args(self, ctx, args):
+        # The group callback runs before the subcommand parses its arguments, so note here whether
+        # they ask for help, in which case there's no need for a project directory.
+        ctx.meta['mtools.help'] = any(arg in ctx.help_option_names for arg in args)
+        return super().parse_args(ctx, args)
+
+    def format_commands(self, ctx, formatter):
+        rows = [(name, COMMANDS[name][2]) for name in sorted(COMMANDS)]
+        if rows:
+            with formatter.section('Commands'):
+                formatter.write_dl(rows)
+
+
+@click.group(cls=LazyGroup)
 @click.option('--debug/--no-debug', default=False)
-def cli(debug):
+@click.option('--profile/--no-profile', default=False,
+              help='Time MTurk API calls and database queries, and print a summary at exit.')
+@click.option('--profile-output', type=click.Path(dir_okay=False), default=None,
+              help='Also dump the profile to this file: Prometheus text format if it ends in .prom, else JSON.')
+@click.pass_context
+def cli(ctx, debug, profile, profile_output):
+    if ctx.resilient_parsing or ctx.meta.get('mtools.help'):
+        return
 
     level = logging.DEBUG if debug else logging.INFO
 
@@ -32,24 +83,26 @@ def cli(debug):
     stream_handler.setFormatter(formatter)
     stream_handler.setLevel(level)
 
-    file_handler = logging.FileHandler(config['logging']['logfile'])
+    file_handler = logging.FileHandler(get_config()['logging']['logfile'])
     file_handler.setFormatter(formatter)
     file_handler.setLevel(level)
 
     logger.addHandler(stream_handler)
     logger.addHandler(file_handler)
 
+    if profile or profile_output:
+        from mtools.metrics import enable
+
+        metrics = enable()
+        metrics.command = ctx.invoked_subcommand
 
-# TODO: Something less tedious
-cli.add_command(mtools.db.init_db)
-cli.add_command(mtools.db.clear_db)
-cli.add_command(mtools.deploy.deploy)
-cli.add_command(mtools.io.load_dataset)
-cli.add_command(mtools.io.create_hittype)
-cli.add_command(mtools.io.create_qualification)
-cli.add_command(mtools.mturk.accept_all)
+        def report():
+            click.echo(metrics.summary(), err=True)
+            if profile_output:
+                metrics.write(profile_output)
+
+        ctx.call_on_close(report)
 
 
 if __name__ == '__main__':
     cli()
-
@@ -1,24 +1,123 @@
 """
 The MTurk client.
 
-Defines `client` to be used as a singleton in other scripts.
+Defines `client` to be used as a singleton in other scripts. The underlying boto3 client is only
+created the first time one of its methods is used.
 """
 import logging
+import threading
 
-import boto3
-
-from mtools.config import config
+from mtools.config import get_config
+from mtools.metrics import instrument_client
 
 
 logger = logging.getLogger(__name__)
 
 
-client = boto3.client(
-    'mturk',
-    region_name=config['mturk'].pop('region_name', None),
-    endpoint_url=config['mturk'].pop('endpoint_url', None),
-    aws_access_key_id=config['mturk'].pop('aws_access_key_id', None),
-    aws_secret_access_key=config['mturk'].pop('secret_access_key', None)
-)
+# Defaults for the performance settings in the [mturk] section of the config.
+DEFAULT_MAX_POOL_CONNECTIONS = 50
+DEFAULT_RETRY_MODE = 'adaptive'
+DEFAULT_MAX_ATTEMPTS = 10
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+
+
+_client = None
+_limited_client = None
+_client_lock = threading.Lock()
+
+
+def make_client(**overrides):
+    """
+    Builds a new MTurk client from the [mturk] section of the config.
+
+    Besides the endpoint and credentials, the section may set `max_pool_connections`,
+    `retry_mode`, `max_attempts`, `connect_timeout` and `read_timeout`. Keyword arguments override
+    the config. Each client gets its own boto3 session, since sessions aren't thread-safe.
+    """
+    # Deferred, since importing boto3 dominates CLI startup.
+    import boto3
+    from botocore.config import Config
+
+    section = get_config()['mturk']
+    settings = {
+        'max_pool_connections': section.getint('max_pool_connections', DEFAULT_MAX_POOL_CONNECTIONS),
+        'retry_mode': section.get('retry_mode', DEFAULT_RETRY_MODE),
+        'max_attempts': section.getint('max_attempts', DEFAULT_MAX_ATTEMPTS),
+        'connect_timeout': section.getfloat('connect_timeout', DEFAULT_CONNECT_TIMEOUT),
+        'read_timeout': section.getfloat('read_timeout', DEFAULT_READ_TIMEOUT),
+    }
+    settings.update(overrides)
+    botocore_config = Config(
+        max_pool_connections=settings['max_pool_connections'],
+        connect_timeout=settings['connect_timeout'],
+        read_timeout=settings['read_timeout'],
+        retries={'mode': settings['retry_mode'], 'total_max_attempts': settings['max_attempts']},
+    )
+    session = boto3.session.Session()
+    client = session.client(
+        'mturk',
+        region_name=section.get('region_name'),
+        endpoint_url=section.get('endpoint_url'),
+        aws_access_key_id=section.get('aws_access_key_id'),
+        aws_secret_access_key=section.get('secret_access_key'),
+        config=botocore_config
+    )
+    logger.info('Client at endpoint: %s', client._endpoint)
+    logger.debug('Client settings: %s', settings)
+    return instrument_client(client)
+
+
+def get_client():
+    """
+    Returns the shared client, creating it on first use.
+
+    boto3 clients are thread-safe once created, so concurrent workers should all use this one:
+    they then share its connection pool and, in adaptive retry mode, its client-side rate limiter.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = make_client()
+    return _client
+
+
+def get_limited_client():
+    """
+    Returns the shared client for calls paced by a `TokenBucket`, creating it on first use.
+
+    It makes a single attempt per call, so that every throttle reaches `call_with_backoff`, which
+    retries it and slows the limiter down, instead of being absorbed by botocore's own retries.
+    """
+    global _limited_client
+    if _limited_client is None:
+        with _client_lock:
+            if _limited_client is None:
+                _limited_client = make_client(retry_mode='standard', max_attempts=1)
+    return _limited_client
+
+
+def client_for(limiter):
+    """The client to make calls paced by `limiter` (None for unpaced calls) with."""
+    return get_limited_client() if limiter is not None else get_client()
+
+
+def check_concurrency(workers):
+    """Warns if more threads will share the client than it has pooled connections."""
+    max_pool_connections = get_client().meta.config.max_pool_connections
+    if workers > max_pool_connections:
+        logger.warning(
+            '%i workers will share %i pooled connections; raise max_pool_connections in [mturk]',
+            workers,
+            max_pool_connections
+        )
+
+
+class _LazyClient:
+    """Forwards attribute access to the client returned by `get_client`."""
+    def __getattr__(self, name):
+        return getattr(get_client(), name)
+
 
-logger.info('Client at endpoint: %s', client._endpoint)
+client = _LazyClient()
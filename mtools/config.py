@@ -1,12 +1,23 @@
 """
 Client / database configuration.
 
-Defines `config` to be used as a singleton in other scripts.
+Defines `get_config` to be used as a singleton in other scripts. The configuration is read on
+first use from the file named by the `MTOOLS_CONFIG` environment variable (default: `config.ini`).
 """
 import configparser
+import functools
+import os
 
 
-config = configparser.ConfigParser()
-
-with open('config.ini', 'r') as config_file:
-    config.read_file(config_file)
+@functools.lru_cache(maxsize=None)
+def get_config():
+    filename = os.environ.get('MTOOLS_CONFIG', 'config.ini')
+    config = configparser.ConfigParser()
+    try:
+        with open(filename, 'r') as config_file:
+            config.read_file(config_file)
+    except FileNotFoundError:
+        raise FileNotFoundError(
+            f'Could not find "{filename}". Run from the project directory or set MTOOLS_CONFIG.'
+        ) from None
+    return config
@@ -2,21 +2,79 @@
 Database Schema, ORM, and related commands.
 """
 from contextlib import contextmanager
+import datetime
+import functools
+import hashlib
+import io
 import logging
 
 import click
-from sqlalchemy import create_engine
-from sqlalchemy import Column, ForeignKey, Integer, UniqueConstraint, String
+from sqlalchemy import create_engine, bindparam, inspect, text
+from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Index, Integer, UniqueConstraint, String
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.sql import exists
 
-from mtools.config import config
+from mtools.config import get_config
+from mtools.metrics import instrument_engine
 
 
 logger = logging.getLogger(__name__)
-engine = create_engine(config['database']['url'])
 Base = declarative_base()
-Session = sessionmaker(bind=engine)
+Session = sessionmaker()
+
+
+# Defaults for the connection settings in the [database] section of the config. The pool settings
+# only apply to server databases such as Postgres.
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MAX_OVERFLOW = 20
+DEFAULT_POOL_TIMEOUT = 30
+DEFAULT_POOL_RECYCLE = 1800
+DEFAULT_SQLITE_TIMEOUT = 30
+
+
+def engine_options(section):
+    """Keyword arguments for `create_engine` from the [database] section of the config."""
+    if section['url'].startswith('sqlite'):
+        # Wait this long for other writers to finish instead of failing with "database is locked".
+        return {'connect_args': {'timeout': section.getfloat('timeout', DEFAULT_SQLITE_TIMEOUT)}}
+    return {
+        'pool_size': section.getint('pool_size', DEFAULT_POOL_SIZE),
+        'max_overflow': section.getint('max_overflow', DEFAULT_MAX_OVERFLOW),
+        'pool_timeout': section.getfloat('pool_timeout', DEFAULT_POOL_TIMEOUT),
+        'pool_recycle': section.getint('pool_recycle', DEFAULT_POOL_RECYCLE),
+        'pool_pre_ping': section.getboolean('pool_pre_ping', True),
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def get_engine():
+    """Creates the engine on first use."""
+    section = get_config()['database']
+    return instrument_engine(create_engine(section['url'], **engine_options(section)))
+
+
+def __getattr__(name):
+    # Keep `mtools.db.engine` working without creating the engine at import time.
+    if name == 'engine':
+        return get_engine()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def utcnow():
+    """The current UTC time, naive, as stored in DateTime columns."""
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def naive_utc(value):
+    """
+    `value` converted to naive UTC for a DateTime column. Times from the MTurk API carry a
+    timezone, which the columns would otherwise drop (or, on SQLite, store as a differently
+    formatted string that no longer compares with `utcnow()`). None and naive times are kept.
+    """
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
 
 
 class Dataset(Base):
@@ -41,10 +99,27 @@ class Instance(Base):
 
     sentence_good = Column(String)
     sentence_bad = Column(String)
+    content_hash = Column(String, index=True)
+    # Denormalized `question != None`, so that finding unasked instances doesn't need an anti-join.
+    asked = Column(Boolean, default=False)
 
     dataset = relationship('Dataset', back_populates='instances')
     question = relationship('Question', uselist=False, back_populates='instance')
 
+    __table_args__ = (
+        # Also serves lookups on dataset_key alone.
+        Index('ix_instances_dataset_key_asked', dataset_key, asked),
+    )
+
+
+def content_hash(sentence_good, sentence_bad):
+    """Identifies an instance by the sentence pair it asks about, regardless of dataset."""
+    hash_ = hashlib.sha1()
+    hash_.update(sentence_good.encode('utf-8'))
+    hash_.update(b'\x00')
+    hash_.update(sentence_bad.encode('utf-8'))
+    return hash_.hexdigest()
+
 
 class HitType(Base):
     __tablename__ = 'hittypes'
@@ -62,23 +137,32 @@ class HitType(Base):
 
 
 class Hit(Base):
+    """
+    A launched HIT. `status` tracks the lifecycle changes made through mtools (`active`, `expired`,
+    `reviewed` or `deleted`); HITs that reach their expiration on their own stay `active`.
+    """
     __tablename__ = 'hits'
 
     key = Column(Integer, primary_key=True)
     hit_type_key = Column(Integer, ForeignKey('hittypes.key'))
 
     hit_id = Column(String, unique=True)
+    max_assignments = Column(Integer)
+    status = Column(String, default='active', index=True)
+    expiration = Column(DateTime)
 
     hit_type = relationship('HitType', back_populates='hits')
     questions = relationship('Question', back_populates='hit')
+    assignments = relationship('Assignment', back_populates='hit')
 
 
 class Question(Base):
     __tablename__ = 'questions'
 
     key = Column(Integer, primary_key=True)
-    hit_key = Column(Integer, ForeignKey('hits.key'))
-    instance_key = Column(Integer, ForeignKey('instances.key'))
+    hit_key = Column(Integer, ForeignKey('hits.key'), index=True)
+    instance_key = Column(Integer, ForeignKey('instances.key'), index=True)
+    launch_chunk_key = Column(Integer, ForeignKey('launch_chunks.key'), index=True)
 
     answer = Column(String)
     choice_a = Column(String)
@@ -86,6 +170,64 @@ class Question(Base):
 
     hit = relationship('Hit', back_populates='questions')
     instance = relationship('Instance', back_populates='question')
+    answers = relationship('Answer', back_populates='question')
+    launch_chunk = relationship('LaunchChunk', back_populates='questions')
+
+
+class LaunchChunk(Base):
+    """
+    Write-ahead journal entry for one HIT of a prepared batch.
+
+    Entries are written, `pending`, in the same transaction that reserves their questions, and only
+    become `published` in the transaction that records the launched HIT.
+    """
+    __tablename__ = 'launch_chunks'
+
+    key = Column(Integer, primary_key=True)
+    batch_id = Column(String)
+    chunk = Column(Integer)
+    batch_filename = Column(String)
+    unique_request_token = Column(String, unique=True)
+    state = Column(String, default='pending', index=True)
+    hit_key = Column(Integer, ForeignKey('hits.key'))
+    created_at = Column(DateTime, default=utcnow)
+
+    hit = relationship('Hit')
+    questions = relationship('Question', back_populates='launch_chunk')
+
+    __table_args__ = (
+        UniqueConstraint(batch_id, chunk),
+    )
+
+
+class Assignment(Base):
+    __tablename__ = 'assignments'
+
+    key = Column(Integer, primary_key=True)
+    hit_key = Column(Integer, ForeignKey('hits.key'), index=True)
+
+    assignment_id = Column(String, unique=True)
+    worker_id = Column(String, index=True)
+    status = Column(String)
+    accept_time = Column(DateTime)
+    submit_time = Column(DateTime)
+    approval_time = Column(DateTime)
+
+    hit = relationship('Hit', back_populates='assignments')
+    answers = relationship('Answer', back_populates='assignment')
+
+
+class Answer(Base):
+    __tablename__ = 'answers'
+
+    key = Column(Integer, primary_key=True)
+    assignment_key = Column(Integer, ForeignKey('assignments.key'), index=True)
+    question_key = Column(Integer, ForeignKey('questions.key'), index=True)
+
+    selection = Column(String)
+
+    assignment = relationship('Assignment', back_populates='answers')
+    question = relationship('Question', back_populates='answers')
 
 
 class Qualification(Base):
@@ -98,10 +240,81 @@ class Qualification(Base):
     qualification_type_id = Column(String)
 
 
+class ApprovedAssignment(Base):
+    """Checkpoint of assignments already approved by `accept_all`."""
+    __tablename__ = 'approved_assignments'
+
+    key = Column(Integer, primary_key=True)
+    assignment_id = Column(String, unique=True)
+
+
+def _copy_value(value):
+    """Formats a value for COPY's text format."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return (
+        str(value).replace('\\', '\\\\')
+                  .replace('\t', '\\t')
+                  .replace('\n', '\\n')
+                  .replace('\r', '\\r')
+    )
+
+
+def copy_rows(connection, table, rows):
+    """
+    Streams rows into a Postgres table with COPY FROM STDIN, through the connection's psycopg
+    (2 or 3) cursor.
+    """
+    # COPY bypasses SQLAlchemy, so fill in the scalar column defaults it would have applied.
+    defaults = {
+        column.name: column.default.arg
+        for column in table.columns
+        if column.default is not None and column.default.is_scalar and column.name not in rows[0]
+    }
+    columns = list(rows[0]) + list(defaults)
+    buffer = io.StringIO()
+    for row in rows:
+        values = [row[name] if name in row else defaults[name] for name in columns]
+        buffer.write('\t'.join(_copy_value(value) for value in values))
+        buffer.write('\n')
+    buffer.seek(0)
+
+    preparer = connection.dialect.identifier_preparer
+    sql = 'COPY {} ({}) FROM STDIN'.format(
+        preparer.format_table(table),
+        ', '.join(preparer.quote(name) for name in columns)
+    )
+    cursor = connection.connection.cursor()
+    try:
+        if hasattr(cursor, 'copy_expert'):
+            cursor.copy_expert(sql, buffer)
+        else:
+            with cursor.copy(sql) as copy:
+                copy.write(buffer.getvalue())
+    finally:
+        cursor.close()
+
+
+def bulk_insert(session, table, rows):
+    """
+    Inserts rows, given as dicts of column values, in the session's transaction: with COPY on
+    Postgres, and with executemany elsewhere.
+    """
+    if not rows:
+        return
+    connection = session.connection()
+    if connection.dialect.name == 'postgresql' and connection.dialect.driver in ('psycopg2', 'psycopg'):
+        copy_rows(connection, table, rows)
+    else:
+        connection.execute(table.insert(), rows)
+
+
 @contextmanager
 def session_scope():
     """Provide a transactional scope around a series of operations."""
-    session = Session()
+    session = Session(bind=get_engine())
     try:
         yield session
         session.commit()
@@ -112,13 +325,98 @@ def session_scope():
         session.close()
 
 
+def add_missing_columns(connection):
+    """
+    Adds columns that were introduced to the schema after a table was created.
+    """
+    inspector = inspect(connection)
+    table_names = set(inspector.get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in table_names:
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=connection.dialect)
+            connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+            logger.info('Added column %s.%s', table.name, column.name)
+
+
+def add_missing_indexes(connection):
+    """
+    Creates indexes that were introduced to the schema after a table was created.
+    """
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(connection)
+                logger.info('Created index %s', index.name)
+
+
+def backfill_content_hashes(session, batch_size=10000):
+    update = (
+        Instance.__table__.update()
+                .where(Instance.__table__.c.key == bindparam('instance_key'))
+                .values(content_hash=bindparam('hash'))
+    )
+    while True:
+        rows = (
+            session.query(Instance.key, Instance.sentence_good, Instance.sentence_bad)
+                   .filter(Instance.content_hash == None)
+                   .limit(batch_size)
+                   .all()
+        )
+        if not rows:
+            break
+        session.execute(update, [
+            {'instance_key': key, 'hash': content_hash(good, bad)} for key, good, bad in rows
+        ])
+        logger.info('Backfilled content hashes for %i instances', len(rows))
+
+
+def backfill_asked(session):
+    asked = exists().where(Question.instance_key == Instance.key)
+    count = (
+        session.query(Instance)
+               .filter(Instance.asked == None)
+               .update({Instance.asked: asked}, synchronize_session=False)
+    )
+    logger.info('Backfilled asked flag for %i instances', count)
+
+
+def backfill_hit_status(session):
+    count = (
+        session.query(Hit)
+               .filter(Hit.status == None)
+               .update({Hit.status: 'active'}, synchronize_session=False)
+    )
+    logger.info('Backfilled status for %i HITs', count)
+
+
 @click.command()
 def init_db():
-    Base.metadata.create_all(engine)
+    Base.metadata.create_all(get_engine())
     logger.info('Initialized database')
 
 
+@click.command()
+def migrate_db():
+    """Bring an existing database up to date with the current schema."""
+    with session_scope() as session:
+        connection = session.connection()
+        Base.metadata.create_all(connection)
+        add_missing_columns(connection)
+        add_missing_indexes(connection)
+        backfill_content_hashes(session)
+        backfill_asked(session)
+        backfill_hit_status(session)
+    logger.info('Migrated database')
+
+
 @click.command()
 def clear_db():
-    Base.metadata.drop_all(engine)
+    Base.metadata.drop_all(get_engine())
     logger.info('Cleared database')
@@ -1,50 +1,137 @@
 """
 Utilities and Commands for deploying MTurk HITs.
 """
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import datetime
+import functools
+import gzip
 import json
 import logging
+import os
 import random
+import uuid
 
 import click
+from sqlalchemy import BigInteger, cast, func
 
-from mtools.client import client
-from mtools.db import session_scope
-from mtools.db import Dataset, Question, Hit, HitType, Instance
-from mtools.question_form import QuestionForm
+from mtools.client import check_concurrency, client_for
+from mtools.db import bulk_insert, session_scope
+from mtools.db import Dataset, Question, HitType, Instance
+from mtools.io import batched
+from mtools.journal import (
+    create_entries, duplicate_hit_id, is_duplicate_request_error, pending_entries, reconcile, record_launch,
+    recover_duplicates, stale_entries
+)
+from mtools.question_form import TemplateQuestionForm, check_question_size
+from mtools.throttle import TokenBucket, call_with_backoff
 
 
 logger = logging.getLogger(__name__)
 
 
-def unasked_instances(session, dataset, n):
+# Multiplier of the MINSTD generator and the Mersenne prime 2^31 - 1. Intermediate products stay
+# well inside 64-bit integers so the hash can be evaluated by any SQL backend, as long as the
+# column is widened first (Postgres integers are 32-bit).
+_MULTIPLIER = 48271
+_PRIME = 2147483647
+
+
+def _mix(value, seed):
+    """Hashes an integer (or integer SQL expression) below _PRIME with a seed."""
+    h = ((value + seed) * _MULTIPLIER) % _PRIME
+    h = (h * h + seed) % _PRIME
+    return (h * _MULTIPLIER) % _PRIME
+
+
+def random_order(column, seed):
+    """
+    A seeded pseudo-random sort key for an integer column, computed in SQL.
+
+    The seed is hashed first: otherwise nearby seeds, such as 1, 2, 3..., merely shift the keys and
+    draw overlapping samples.
     """
-    Retrieves up to n unasked instances in the specified dataset.
+    return _mix(cast(column, BigInteger), _mix(seed % _PRIME, 0))
+
+
+def get_instance_keys(session, datasets, num_questions, seed):
+    """
+    Draws a seeded, stratified random sample of unasked instance keys in a single query.
+
+    Unasked instances are ranked in a random order within each dataset, and the sample takes
+    instances rank by rank across all datasets. Each dataset therefore gets an equal share of the
+    questions, and the shortfall of an exhausted dataset is spread over the rest.
     """
-    instances = (
-        session.query(Instance)
-                .filter(Instance.dataset == dataset)
-                .filter(Instance.question == None)
-                .limit(n)
-                .all()
+    order = random_order(Instance.key, seed)
+    ranked = (
+        session.query(
+            Instance.key.label('key'),
+            order.label('order'),
+            func.row_number().over(
+                partition_by=Instance.dataset_key,
+                order_by=(order, Instance.key)
+            ).label('rank')
+        )
+        .filter(Instance.dataset_key.in_([dataset.key for dataset in datasets]))
+        .filter(Instance.asked == False)
+        .subquery()
     )
-    return instances
-
-
-def get_instances(session, datasets, questions_per_dataset):
-    # Try to get the requested number of questions; if a dataset is exhausted then allocate more
-    # questions from the next dataset. Break into HIT-sized chunks at the end.
-    instances = []
-    reserve = 0
-    for dataset in datasets:
-        instances_ = unasked_instances(
-            session,
-            dataset,
-            questions_per_dataset + reserve
+    keys = [
+        key for key, in
+        session.query(ranked.c.key)
+               .order_by(ranked.c.rank, ranked.c.order, ranked.c.key)
+               .limit(num_questions)
+    ]
+    random.Random(seed).shuffle(keys)
+    return keys
+
+
+def lock_instances(session, keys, chunk_size=500):
+    """
+    Locks the rows of the given instances that are still unasked, skipping rows that another
+    transaction has locked (SELECT ... FOR UPDATE SKIP LOCKED). Returns the locked keys in the given
+    order.
+
+    SQLite has no row locks, so there this only filters out instances that were asked meanwhile.
+    """
+    locked = set()
+    for batch in batched(keys, chunk_size):
+        locked.update(
+            key for key, in
+            session.query(Instance.key)
+                   .filter(Instance.key.in_(batch))
+                   .filter(Instance.asked == False)
+                   .with_for_update(skip_locked=True)
         )
-        reserve += questions_per_dataset - len(instances_)
-        instances.extend(instances_)
-    random.shuffle(instances)
-    return instances
+    return [key for key in keys if key in locked]
+
+
+def claim_instance_keys(session, datasets, num_questions, seed, max_rounds=5):
+    """
+    Samples unasked instance keys like `get_instance_keys`, and locks them until the end of the
+    transaction, so that concurrent deploys on Postgres never claim the same instances.
+
+    FOR UPDATE can't be combined with the window function that draws the sample, so the sample is
+    locked after being drawn. Instances another deploy got to first are replaced by drawing a
+    larger sample with the same seed.
+    """
+    claimed = []
+    skipped = set()
+    for _ in range(max_rounds):
+        seen = skipped.union(claimed)
+        candidates = [
+            key for key in get_instance_keys(session, datasets, num_questions + len(skipped), seed)
+            if key not in seen
+        ]
+        if not candidates:
+            break
+        locked = lock_instances(session, candidates)
+        claimed.extend(locked)
+        skipped.update(set(candidates).difference(locked))
+        if len(claimed) >= num_questions:
+            break
+    if skipped:
+        logger.info('Skipped %i instances claimed by a concurrent deploy', len(skipped))
+    return claimed[:num_questions]
 
 
 def chunk_list(x, chunk_size):
@@ -52,91 +139,351 @@ def chunk_list(x, chunk_size):
     return [x[i:i + chunk_size] for i in range(0, len(x), chunk_size)]
 
 
-def create_question(instance):
+def question_values(sentence_good, sentence_bad, rng=random):
     """
-    Creates a question from an instance.
+    The column values of a question asking to pick the good sentence, in a random position.
     """
-    correct = instance.sentence_good
-    incorrect = instance.sentence_bad
-    answer = random.choice(['a', 'b'])
+    answer = rng.choice(['a', 'b'])
     noflip = answer == 'a'
-    choice_a = correct if noflip else incorrect
-    choice_b = incorrect if noflip else correct
-    question = Question(
-        instance=instance,
-        answer=answer,
-        choice_a=choice_a,
-        choice_b=choice_b
-    )
-    return question
+    return {
+        'answer': answer,
+        'choice_a': sentence_good if noflip else sentence_bad,
+        'choice_b': sentence_bad if noflip else sentence_good,
+    }
 
 
-def create_question_form(overview, questions):
+def reserve_questions(session, instance_keys, rng=random, launch_chunk_keys=None, chunk_size=500):
     """
-    Creates a question form from an overview and a list of questions.
+    Creates a question for each instance and marks the instances asked.
+
+    Questions are bulk inserted (with COPY on Postgres) and the instances marked with bulk updates,
+    bypassing the ORM. `launch_chunk_keys` optionally maps instance keys to the journal entry of
+    the HIT their question is for. Returns (question key, choice_a, choice_b) tuples in the order
+    of `instance_keys`.
     """
-    question_form = QuestionForm()
+    launch_chunk_keys = launch_chunk_keys or {}
+    choices = {}
+    for keys in batched(instance_keys, chunk_size):
+        rows = []
+        for key, good, bad in (
+            session.query(Instance.key, Instance.sentence_good, Instance.sentence_bad)
+                   .filter(Instance.key.in_(keys))
+        ):
+            values = question_values(good, bad, rng=rng)
+            rows.append(dict(values, instance_key=key, launch_chunk_key=launch_chunk_keys.get(key)))
+            choices[key] = (values['choice_a'], values['choice_b'])
+        bulk_insert(session, Question.__table__, rows)
+        (
+            session.query(Instance)
+                   .filter(Instance.key.in_(keys))
+                   .update({Instance.asked: True}, synchronize_session=False)
+        )
+    # Each instance is only ever asked once, so its question is found by instance key.
+    question_keys = {}
+    for keys in batched(instance_keys, chunk_size):
+        question_keys.update(
+            session.query(Question.instance_key, Question.key)
+                   .filter(Question.instance_key.in_(keys))
+        )
+    return [(question_keys[key],) + choices[key] for key in instance_keys]
+
+
+def render_question(overview, questions):
+    """
+    Renders and size-checks the question form of one HIT.
+
+    `questions` are (key, choice_a, choice_b) tuples, so that chunks are cheap to send to other
+    processes.
+    """
+    question_form = TemplateQuestionForm()
     question_form.add_overview(**overview)
-    for question in questions:
+    for key, choice_a, choice_b in questions:
         question_form.add_multiple_choice_question(
-            question_identifier=str(question.key),
-            choices=[question.choice_a, question.choice_b]
+            question_identifier=str(key),
+            choices=[choice_a, choice_b]
         )
-    return question_form
+    question_xml = question_form.tostring()
+    check_question_size(question_xml)
+    return question_xml
 
 
-@click.command()
-@click.option('-n', '--num_hits', required=True, type=int)
-@click.option('-q', '--questions_per_hit', required=True, type=int)
-@click.option('--max_assignments', type=int, default=3)
-@click.option('--lifetime_in_seconds', type=int, default=604800)  # Default: 1 week
-@click.option('--overview_filename', type=str, default='templates/overview.json')
-@click.argument('hit_type_short_name')
-def deploy(hit_type_short_name,
-           num_hits,
-           questions_per_hit,
-           max_assignments,
-           lifetime_in_seconds,
-           overview_filename):
-    logger.info('Deploying HITs w/ type "%s"', hit_type_short_name)
-    with open(overview_filename, 'r') as f:
-        overview = json.load(f)
+def render_questions(overview, chunks, processes=1):
+    """
+    Renders the question form of each chunk, in order, over a pool of `processes` processes.
+    """
+    render = functools.partial(render_question, overview)
+    if processes <= 1:
+        yield from map(render, chunks)
+        return
+    chunksize = max(1, len(chunks) // (4 * processes))
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        yield from executor.map(render, chunks, chunksize=chunksize)
 
-    with session_scope() as session:
-        hit_type = (
-            session.query(HitType)
-                   .filter(HitType.short_name == hit_type_short_name)
-                   .one()
+
+def open_batch(filename, mode='rt', compressed=None):
+    """Opens a batch file, gzipped if `compressed` or, by default, if its name ends in `.gz`."""
+    if compressed is None:
+        compressed = filename.endswith('.gz')
+    if compressed:
+        return gzip.open(filename, mode, encoding='utf-8')
+    return open(filename, mode, encoding='utf-8')
+
+
+def default_batch_filename(hit_type_short_name):
+    timestamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    return os.path.join('batches', f'{hit_type_short_name}-{timestamp}.jsonl')
+
+
+def prepare_batch(session, filename, hit_type, overview, num_hits, questions_per_hit, max_assignments,
+                  lifetime_in_seconds, seed, processes=1):
+    """
+    Reserves instances for a launch and renders its HITs into a batch file.
+
+    The batch is JSON lines: a header with the launch parameters, then one record per HIT with its
+    chunk index, question keys and rendered question form. Each HIT is journaled as pending along
+    with the reservation. The batch is written to a temporary file that is only moved to
+    `filename` once the reservation is committed, so a failure leaves neither reserved instances
+    without a batch nor a batch without reserved instances.
+    """
+    if os.path.exists(filename):
+        # It may hold HITs that still need publishing.
+        raise FileExistsError(f'Batch file {filename} already exists')
+    datasets = session.query(Dataset).all()
+    instance_keys = claim_instance_keys(session, datasets, num_hits * questions_per_hit, seed)
+    if num_hits * questions_per_hit > len(instance_keys):
+        logger.warning(
+            'Only %i unasked instances; preparing %i HITs instead of %i',
+            len(instance_keys),
+            len(chunk_list(instance_keys, questions_per_hit)),
+            num_hits
         )
-        datasets = session.query(Dataset).all()
-        total_questions = num_hits * questions_per_hit
-        questions_per_dataset = total_questions / len(datasets)
-        instances = get_instances(session, datasets, questions_per_dataset)
-        instance_chunks = chunk_list(instances, questions_per_hit)
-        if num_hits > len(instance_chunks):
-            logger.warn(
-                'Attempting to create %i HITs instead of %i',
-                len(instance_chunks),
-                num_hits
-            )
-        for instance_chunk in instance_chunks:
-            questions = [create_question(i) for i in instance_chunk]
-            session.commit()  # So the keys exist
-            question_form = create_question_form(overview, questions)
-            response = client.create_hit_with_hit_type(
-                HITTypeId=hit_type.hit_type_id,
-                MaxAssignments=max_assignments,
-                LifetimeInSeconds=604800,  # 1 week
-                Question=question_form.tostring(),
-            )
+    batch_id = uuid.uuid4().hex
+    num_chunks = len(chunk_list(instance_keys, questions_per_hit))
+    entry_keys = create_entries(session, batch_id, os.path.abspath(filename), num_chunks)
+    launch_chunk_keys = {
+        instance_key: entry_keys[i // questions_per_hit] for i, instance_key in enumerate(instance_keys)
+    }
+    questions = reserve_questions(
+        session,
+        instance_keys,
+        rng=random.Random(seed),
+        launch_chunk_keys=launch_chunk_keys
+    )
+    chunks = chunk_list(questions, questions_per_hit)
+    header = {
+        'batch_id': batch_id,
+        'hit_type': hit_type.short_name,
+        'hit_type_id': hit_type.hit_type_id,
+        'max_assignments': max_assignments,
+        'lifetime_in_seconds': lifetime_in_seconds,
+        'seed': seed,
+        'num_chunks': len(chunks),
+    }
+
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_filename = f'{filename}.tmp'
+    try:
+        with open_batch(tmp_filename, 'wt', compressed=filename.endswith('.gz')) as f:
+            f.write(json.dumps(header) + '\n')
+            question_xmls = render_questions(overview, chunks, processes)
+            for index, (chunk, question_xml) in enumerate(zip(chunks, question_xmls)):
+                record = {
+                    'chunk': index,
+                    'question_keys': [key for key, _, _ in chunk],
+                    'question': question_xml,
+                }
+                f.write(json.dumps(record) + '\n')
+        session.commit()
+    except:  # noqa: E722
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+    os.replace(tmp_filename, filename)
+    logger.info('Prepared %i HITs (%i questions) in %s', len(chunks), len(questions), filename)
+    return header
+
+
+def read_batch_header(filename):
+    """Returns the launch parameters of a batch file."""
+    with open_batch(filename) as f:
+        return json.loads(f.readline())
+
+
+def iter_batch(filename):
+    """Streams the HIT records of a batch file."""
+    with open_batch(filename) as f:
+        f.readline()
+        for line in f:
+            yield json.loads(line)
+
+
+def publish_batch(session, filename, workers=1, max_rps=None):
+    """
+    Launches the HITs of a batch file that are still pending in the launch journal.
+
+    Records are streamed from the file, and only the API calls run on the worker threads. Each
+    request carries its chunk's UniqueRequestToken, so rerunning a failed or interrupted publish
+    never launches a HIT twice: MTurk rejects the repeated request, and the HIT it already created
+    is looked up and recorded instead. Chunks journaled longer ago than MTurk remembers tokens for
+    are looked up by their annotation before being sent again. Returns the number of HITs launched.
+    """
+    header = read_batch_header(filename)
+    if 'batch_id' not in header:
+        raise ValueError(f'{filename} predates the launch journal; prepare the HITs again')
+    hit_type_key, = (
+        session.query(HitType.key)
+               .filter(HitType.short_name == header['hit_type'])
+               .one()
+    )
+    stale = stale_entries(session, header['batch_id'])
+    if stale:
+        logger.info('Looking up %i chunks journaled before the UniqueRequestToken window', len(stale))
+        reconcile(session, stale)
+    pending_chunks = pending_entries(session, header['batch_id'])
+    skipped = header['num_chunks'] - len(pending_chunks)
+    if skipped:
+        logger.info('Skipping %i HITs that were already published', skipped)
+
+    limiter = TokenBucket(max_rps) if max_rps else None
+    check_concurrency(workers)
+
+    # The session is only ever touched from this thread; workers just make the API calls. Keep a
+    # bounded number of calls in flight and record each HIT as soon as its call returns.
+    pending = {}
+    duplicates = []
+    error = None
+    launched = 0
+
+    def drain(return_when):
+        nonlocal error, launched
+        done, _ = wait(pending, return_when=return_when)
+        for future in done:
+            chunk, key, token = pending.pop(future)
+            try:
+                response = future.result()
+            except Exception as e:
+                if is_duplicate_request_error(e):
+                    duplicates.append((key, token, duplicate_hit_id(e)))
+                    continue
+                logger.error('Failed to create HIT for chunk %i: %s', chunk, e)
+                error = error or e
+                continue
             logger.info("Create HIT with HITType response: %s", response)
-            hit_id = response['HIT']['HITId']
-            hit = Hit(
-                hit_id=hit_id,
-                hit_type=hit_type
+            record_launch(session, key, hit_type_key, response['HIT'])
+            launched += 1
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for record in iter_batch(filename):
+            if error is not None:
+                break
+            if record['chunk'] not in pending_chunks:
+                continue
+            key, token = pending_chunks[record['chunk']]
+            future = executor.submit(
+                call_with_backoff,
+                limiter,
+                client_for(limiter).create_hit_with_hit_type,
+                HITTypeId=header['hit_type_id'],
+                MaxAssignments=header['max_assignments'],
+                LifetimeInSeconds=header['lifetime_in_seconds'],
+                Question=record['question'],
+                UniqueRequestToken=token,
+                RequesterAnnotation=token,
             )
-            for question in questions:
-                question.hit = hit
-            session.add(hit)
-            session.add_all(questions)
-            session.commit()  # Don't want to rollback successful launches
+            pending[future] = (record['chunk'], key, token)
+            if len(pending) >= 2 * workers:
+                drain(FIRST_COMPLETED)
+        while pending:
+            drain(FIRST_COMPLETED)
+
+    if duplicates:
+        logger.info('Recovering %i HITs launched by an earlier run', len(duplicates))
+        missing = recover_duplicates(session, hit_type_key, duplicates)
+        for _, token in missing:
+            logger.error('MTurk has seen %s but no HIT was found for it', token)
+        if missing and error is None:
+            error = RuntimeError(f'{len(missing)} HITs could not be recovered; see `recover-launches`')
+
+    if limiter is not None and limiter.throttle_count:
+        logger.info('Throttled %i times', limiter.throttle_count)
+    if error is not None:
+        logger.error('Launched %i HITs before failing; rerun `publish %s` to resume', launched, filename)
+        raise error
+    logger.info('Launched %i HITs from %s', launched, filename)
+    return launched
+
+
+def _prepare(session, hit_type_short_name, batch_filename, overview_filename, seed, **kwargs):
+    with open(overview_filename, 'r') as f:
+        overview = json.load(f)
+    hit_type = (
+        session.query(HitType)
+               .filter(HitType.short_name == hit_type_short_name)
+               .one()
+    )
+    if seed is None:
+        seed = random.randrange(_PRIME)
+    logger.info('Sampling instances with seed %i', seed)
+    return prepare_batch(session, batch_filename, hit_type, overview, seed=seed, **kwargs)
+
+
+def launch_options(command):
+    """The options shared by the commands that sample and render HITs."""
+    options = [
+        click.option('-n', '--num_hits', required=True, type=int),
+        click.option('-q', '--questions_per_hit', required=True, type=int),
+        click.option('--max_assignments', type=int, default=2,
+                     help='Assignments per HIT to start with; schedule-assignments adds more where needed.'),
+        click.option('--lifetime_in_seconds', type=int, default=604800),  # Default: 1 week
+        click.option('--overview_filename', type=str, default='templates/overview.json'),
+        click.option('--seed', type=int, default=None, help='Seed for sampling instances.'),
+        click.option('-p', '--processes', type=int, default=1, help='Number of processes rendering HITs.'),
+        click.option('-o', '--batch', 'batch_filename', type=str, default=None,
+                     help='Batch file to write; defaults to batches/<hit type>-<timestamp>.jsonl.'),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+@click.command()
+@launch_options
+@click.argument('hit_type_short_name')
+def prepare(hit_type_short_name, batch_filename, **kwargs):
+    """
+    Reserves instances and renders HITs into a batch file for `publish`.
+    """
+    batch_filename = batch_filename or default_batch_filename(hit_type_short_name)
+    with session_scope() as session:
+        _prepare(session, hit_type_short_name, batch_filename, **kwargs)
+    click.echo(batch_filename)
+
+
+@click.command()
+@click.option('-w', '--workers', type=int, default=1, help='Number of concurrent create_hit calls.')
+@click.option('--max-rps', type=float, default=None, help='Shared limit on create_hit calls per second.')
+@click.argument('batch_filename')
+def publish(batch_filename, workers, max_rps):
+    """
+    Launches the HITs in a batch file written by `prepare`, resuming where a previous run stopped.
+    """
+    with session_scope() as session:
+        publish_batch(session, batch_filename, workers=workers, max_rps=max_rps)
+
+
+@click.command()
+@launch_options
+@click.option('-w', '--workers', type=int, default=1, help='Number of concurrent create_hit calls.')
+@click.option('--max-rps', type=float, default=None, help='Shared limit on create_hit calls per second.')
+@click.argument('hit_type_short_name')
+def deploy(hit_type_short_name, batch_filename, workers, max_rps, **kwargs):
+    """
+    Prepares a batch of HITs and publishes it.
+    """
+    logger.info('Deploying HITs w/ type "%s"', hit_type_short_name)
+    batch_filename = batch_filename or default_batch_filename(hit_type_short_name)
+    with session_scope() as session:
+        _prepare(session, hit_type_short_name, batch_filename, **kwargs)
+        publish_batch(session, batch_filename, workers=workers, max_rps=max_rps)
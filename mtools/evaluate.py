@@ -1,49 +1,239 @@
 """
 Utilities and Commands for evaluating results
 """
-from collections import defaultdict
+import contextlib
+import itertools
+import logging
+import queue
+import threading
 
-import xml.etree.ElementTree as xml
+from xml.parsers import expat
+
+import click
 
 from mtools.client import client
 from mtools.db import session_scope
-from mtools.db import Hit, HitType, Question, Qualification
+from mtools.db import Answer, Assignment, Dataset, Hit, HitType, Instance, Question
+from mtools.monitor import NO_VARIABILITY, QualificationEnforcer, WorkerMonitor, qualification_type_id
+
+
+logger = logging.getLogger(__name__)
 
 
 NAMESPACE = {
     'mturk': 'http://mechanicalturk.amazonaws.com/AWSMechanicalTurkDataSchemas/2005-10-01/QuestionFormAnswers.xsd'
 }
 
+# Element names as reported by an expat parser with namespace_separator=' '.
+_ANSWER = NAMESPACE['mturk'] + ' Answer'
+_QUESTION_IDENTIFIER = NAMESPACE['mturk'] + ' QuestionIdentifier'
+_SELECTION_IDENTIFIER = NAMESPACE['mturk'] + ' SelectionIdentifier'
 
-def submitted_assignments(hit_ids):
-    for hit_id in hit_ids:
-        response = client.list_assignments_for_hit(
-            HITId=hit_id,
-            MaxResults=100,
-            AssignmentStatuses=['Submitted']
-        )
-        for assignment in response['Assignments']:
-            yield assignment
-        while 'NextToken' in response:
-            response = client.list_assignments_for_hit(
-                HITId=hit_id,
-                NextToken=response['NextToken'],
-                MaxResults=100,
-                AssignmentStatuses=['Submitted', 'Approved']
-            )
-            for assignment in response['Assignments']:
-                yield assignment
+
+def assignments_for_hit(hit_id, statuses=('Submitted',)):
+    """
+    Pages through the assignments of a single HIT, using the same status filter on every page.
+    """
+    kwargs = {'HITId': hit_id, 'MaxResults': 100, 'AssignmentStatuses': list(statuses)}
+    while True:
+        response = client.list_assignments_for_hit(**kwargs)
+        yield from response['Assignments']
+        if 'NextToken' not in response:
+            break
+        kwargs['NextToken'] = response['NextToken']
+
+
+def submitted_assignments(hit_ids, statuses=('Submitted',), workers=8, max_queue=1000):
+    """
+    Fetches the assignments of many HITs concurrently.
+
+    HIT ids are handed out lazily to a pool of worker threads, which push assignments onto a
+    bounded queue as pages arrive. Assignments are yielded in arrival order, not HIT order.
+    """
+    hit_ids = iter(hit_ids)
+    hit_ids_lock = threading.Lock()
+    results = queue.Queue(maxsize=max_queue)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Give up if the consumer has gone away, rather than blocking forever on a full queue.
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def work():
+        try:
+            while not stop.is_set():
+                with hit_ids_lock:
+                    hit_id = next(hit_ids, None)
+                if hit_id is None:
+                    break
+                for assignment in assignments_for_hit(hit_id, statuses):
+                    if not put(assignment):
+                        return
+        except Exception as e:
+            put(e)
+        finally:
+            put(done)
+
+    threads = [threading.Thread(target=work, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    try:
+        remaining = len(threads)
+        while remaining:
+            item = results.get()
+            if item is done:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def parse_answers(answer_xml):
+    """
+    Parses the answers of a single assignment in one pass with expat.
+
+    Returns a list of (question_key, selection) tuples, along with a list of messages describing
+    answers that could not be read (e.g. free-text answers, which have no SelectionIdentifier).
+    """
+    answers = []
+    errors = []
+    question_key = None
+    selection = None
+    # Leaf text arrives in a single callback since buffer_text is set, and is consumed by the end tag
+    # of the element that contains it. Start tags reset it, so that whitespace between the tags of
+    # indented XML is never taken for a leaf's text.
+    text = None
+
+    def start(name, attributes):
+        nonlocal text
+        text = None
+
+    def data(chunk):
+        nonlocal text
+        text = chunk
+
+    def end(name):
+        nonlocal question_key, selection, text
+        if name == _QUESTION_IDENTIFIER:
+            if question_key is None:
+                question_key = text
+        elif name == _SELECTION_IDENTIFIER:
+            if selection is None:
+                selection = text
+        elif name == _ANSWER:
+            if question_key is None:
+                errors.append('Answer has no QuestionIdentifier')
+            elif selection is None:
+                errors.append(f'Answer to question {question_key} has no SelectionIdentifier')
+            else:
+                try:
+                    answers.append((int(question_key), selection))
+                except ValueError:
+                    errors.append(f'Answer has a non-integer QuestionIdentifier: {question_key!r}')
+            question_key = None
+            selection = None
+        text = None
+
+    parser = expat.ParserCreate(namespace_separator=' ')
+    parser.buffer_text = True
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = data
+    try:
+        parser.Parse(answer_xml, True)
+    except expat.ExpatError as e:
+        errors.append(f'Malformed answer XML: {e}')
+    return answers, errors
 
 
 def parse_answer_xml(answer_xml):
-    root = xml.fromstring(answer_xml)
-    answers = root.findall('mturk:Answer', NAMESPACE)
-    results = []
-    for answer in answers:
-        question_key = answer.find('mturk:QuestionIdentifier', NAMESPACE)
-        selected = answer.find('mturk:SelectionIdentifier', NAMESPACE)
-        results.append((int(question_key.text), selected.text))
-    return results
+    answers, errors = parse_answers(answer_xml)
+    for error in errors:
+        logger.warning(error)
+    return answers
+
+
+def parse_assignments(assignments):
+    """
+    Parses the answers of a stream of assignments, yielding (assignment, answers) pairs.
+
+    Answers that could not be read are logged and left out.
+    """
+    for assignment in assignments:
+        answers, errors = parse_answers(assignment['Answer'])
+        for error in errors:
+            logger.warning('Assignment %s: %s', assignment['AssignmentId'], error)
+        yield assignment, answers
+
+
+def stored_assignments(session, hit_type_key, statuses=('Submitted',)):
+    """
+    Reads the assignments of a HIT type back out of the local store (see `sync-assignments`).
+
+    Yields (assignment, answers) pairs like `parse_assignments`, with a single query.
+    """
+    rows = (
+        session.query(
+            Assignment.key,
+            Assignment.assignment_id,
+            Assignment.worker_id,
+            Assignment.accept_time,
+            Assignment.submit_time,
+            Hit.hit_id,
+            Answer.question_key,
+            Answer.selection
+        )
+        .join(Hit, Assignment.hit_key == Hit.key)
+        .outerjoin(Answer, Answer.assignment_key == Assignment.key)
+        .filter(Hit.hit_type_key == hit_type_key)
+        .filter(Assignment.status.in_(statuses))
+        .order_by(Assignment.key, Answer.key)
+    )
+    for _, group in itertools.groupby(rows, key=lambda row: row.key):
+        group = list(group)
+        first = group[0]
+        assignment = {
+            'AssignmentId': first.assignment_id,
+            'WorkerId': first.worker_id,
+            'HITId': first.hit_id,
+            'AcceptTime': first.accept_time,
+            'SubmitTime': first.submit_time,
+        }
+        answers = [(row.question_key, row.selection) for row in group if row.question_key is not None]
+        yield assignment, answers
+
+
+def local_assignments(hit_type_key, statuses=('Submitted',)):
+    with session_scope() as session:
+        yield from stored_assignments(session, hit_type_key, statuses)
+
+
+def load_answer_key(session, hit_type):
+    """
+    Loads the answer key for every question launched under a HIT type.
+
+    Returns a dict mapping question key -> (correct answer, dataset filename).
+    """
+    rows = (
+        session.query(Question.key, Question.answer, Dataset.filename)
+               .join(Hit, Question.hit_key == Hit.key)
+               .join(Instance, Question.instance_key == Instance.key)
+               .join(Dataset, Instance.dataset_key == Dataset.key)
+               .filter(Hit.hit_type_key == hit_type.key)
+    )
+    return {key: (answer, filename) for key, answer, filename in rows}
 
 
 def reject_assignment(assignment, feedback):
@@ -69,7 +259,35 @@ def reject_assignment(assignment, feedback):
     # )
 
 
-def evaluate(hit_type_short_name):
+@click.command()
+@click.argument('hit_type_short_name')
+@click.option('--local/--remote', default=False,
+              help='Score assignments from the local store (see sync-assignments).')
+@click.option('-o', '--output_dir', type=str, default='results')
+@click.option('--format', 'format_', type=click.Choice(['csv', 'json']), default='csv')
+@click.option('--bootstrap', type=int, default=200, help='Bootstrap replicates for confidence intervals.')
+@click.option('--min-seconds-per-question', type=float, default=2.0)
+@click.option('--min-agreement', type=float, default=0.6)
+@click.option('--exclude-flagged/--include-flagged', default=False,
+              help='Leave every assignment of flagged workers out of the scores, not only those that pick '
+                   'the same choice throughout.')
+@click.option('--enforce/--no-enforce', default=False, help='Grant flagged workers a disqualification.')
+@click.option('--qualification', type=str, default='bad-worker', help='Short name of the disqualification.')
+@click.option('--max-rps', type=float, default=None, help='Shared limit on qualification calls per second.')
+def evaluate(hit_type_short_name,
+             local,
+             output_dir,
+             format_,
+             bootstrap,
+             min_seconds_per_question,
+             min_agreement,
+             exclude_flagged,
+             enforce,
+             qualification,
+             max_rps):
+    # Imported here so that commands which only fetch assignments don't pay for importing NumPy.
+    from mtools.scoring import Responses, score, write_tables
+
     # Get the HIT ids
     with session_scope() as session:
         hit_type = (
@@ -79,62 +297,57 @@ def evaluate(hit_type_short_name):
         )
         hits = session.query(Hit).filter(Hit.hit_type == hit_type).all()
         hit_ids = [hit.hit_id for hit in hits]
-    print(hit_ids)
-
-    turker_correct = defaultdict(int)
-    turker_total = defaultdict(int)
-    db_correct = defaultdict(int)
-    db_total = defaultdict(int)
-    question_correct = defaultdict(int)
-    question_total = defaultdict(int)
-    for assignment in submitted_assignments(hit_ids):
-        print(f"--worker-id {assignment['WorkerId']} --assignment-id {assignment['AssignmentId']}")
-        answers = parse_answer_xml(assignment['Answer'])
-
-        # Check for nefarious answers
-        all_a = all(map(lambda x: x[1]=='a', answers))
-        all_b = all(map(lambda x: x[1]=='b', answers))
-        if all_a or all_b:
-            # reject_assignment(
-            #     assignment,
-            #     'We detected no variability in your answers.'
-            # )
+        hit_type_key = hit_type.key
+        answer_key = load_answer_key(session, hit_type)
+        if enforce:
+            enforcer = QualificationEnforcer(qualification_type_id(session, qualification), max_rps=max_rps)
+        else:
+            enforcer = contextlib.nullcontext()
+    logger.debug('HIT ids: %s', hit_ids)
+
+    if local:
+        assignments = local_assignments(hit_type_key)
+    else:
+        assignments = parse_assignments(submitted_assignments(hit_ids))
+    monitor = WorkerMonitor(
+        answer_key,
+        min_seconds_per_question=min_seconds_per_question,
+        min_agreement=min_agreement
+    )
+    # First pass: check every assignment for nefarious answers, flagging (and optionally
+    # disqualifying) workers as results stream in.
+    answers_by_worker = []
+    with enforcer:
+        for assignment, answers in assignments:
+            worker_id = assignment['WorkerId']
+            logger.debug(f"--worker-id {worker_id} --assignment-id {assignment['AssignmentId']}")
+            reasons = monitor.observe(assignment, answers)
+            if enforce:
+                if monitor.is_flagged(worker_id):
+                    enforcer.flag(worker_id)
+                else:
+                    enforcer.poll()
+            answers_by_worker.append((worker_id, answers, NO_VARIABILITY in reasons))
+
+    # Second pass: score once every flag is known, so that excluding a worker drops all of their
+    # work whatever order their assignments arrived in. Assignments that pick the same choice
+    # throughout are never scored.
+    responses = Responses(answer_key)
+    for worker_id, answers, no_variability in answers_by_worker:
+        if no_variability or (exclude_flagged and monitor.is_flagged(worker_id)):
             continue
+        for question_id, answer in answers:
+            responses.add(worker_id, question_id, answer)
 
-        # TODO: Lazy. Clean up.
-        with session_scope() as session:
-            for question_id, answer in answers:
-                question = (
-                    session.query(Question)
-                           .filter(Question.key == question_id)
-                           .one()
-                )
-                correct = answer == question.answer
-                worker_id = assignment['WorkerId']
-                dataset = question.instance.dataset.filename
-                db_correct[dataset] += correct
-                db_total[dataset] += 1
-                turker_correct[worker_id] += correct
-                turker_total[worker_id] += 1
-                question_correct[question_id] += correct
-                question_total[question_id] += 1
-
-    for key in db_correct:
-        print(f'{key}:: {db_correct[key] / db_total[key]}')
-    for key in turker_correct:
-        print(f'{key}:: {turker_correct[key] / turker_total[key]}')
-    for key in question_correct:
-        print(f'{key}:: {question_correct[key]} / {question_total[key]}')
-
-
-
-        # add_answers(answers)
-        # client.approve_assignment(
-            # AssignmendId=assignment['AssignmentId'],
-            # RequesterFeedback='Thank you for your work!'
-        # )
+    logger.info('Scoring %i responses', len(responses))
+    tables = score(responses.freeze(), num_bootstrap=bootstrap)
+    tables['flagged'] = [
+        {'worker': worker_id, 'reasons': '; '.join(reasons)}
+        for worker_id, reasons in monitor.flagged.items()
+    ]
+    write_tables(tables, output_dir, format=format_)
+    logger.info('Wrote results to "%s"', output_dir)
 
 
 if __name__ == '__main__':
-    evaluate('qualified_eval')
-
+    evaluate()
@@ -0,0 +1,264 @@
+"""
+Columnar export of every stored response, for analysis outside of mtools.
+
+Responses are streamed out of the database with a server-side cursor in fixed-size batches, so
+memory stays bounded however many there are, and written one batch at a time to a format that
+can be memory-mapped:
+
+* `.parquet`: Parquet, for pandas, polars, DuckDB, Spark...
+* `.arrow` or `.feather`: an uncompressed Arrow IPC file, which opens instantly with
+  `pyarrow.ipc.open_file(pyarrow.memory_map(filename)).read_all()`.
+* anything else: a directory of `.npy` columns (see `open_npy`), which needs nothing but NumPy.
+
+Parquet and Arrow require pyarrow (`pip install pyarrow`).
+"""
+import logging
+import os
+import shutil
+import time
+
+import click
+import numpy as np
+
+from mtools.db import session_scope
+from mtools.db import Answer, Assignment, Dataset, Hit, HitType, Instance, Question
+from mtools.io import batched
+
+
+logger = logging.getLogger(__name__)
+
+
+# Column name -> NumPy dtype. String columns are categorical: stored in `.npy` exports as int32
+# codes into a `<name>.labels.npy` array.
+COLUMNS = {
+    'worker_id': str,
+    'assignment_id': str,
+    'hit_id': str,
+    'status': str,
+    'question_key': np.int64,
+    'dataset': str,
+    'eval_type': str,
+    'selection': str,
+    'answer_position': str,
+    'correct': np.bool_,
+}
+
+FORMATS = {
+    '.parquet': 'parquet',
+    '.arrow': 'arrow',
+    '.feather': 'arrow',
+}
+
+
+def response_rows(session, hit_type_keys=None, statuses=None, batch_size=50000):
+    """
+    Streams (worker id, assignment id, HIT id, status, question key, dataset filename, eval type,
+    selection, answer) rows for every stored answer, fetching `batch_size` rows at a time.
+    """
+    query = (
+        session.query(
+            Assignment.worker_id,
+            Assignment.assignment_id,
+            Hit.hit_id,
+            Assignment.status,
+            Answer.question_key,
+            Dataset.filename,
+            Dataset.eval_type,
+            Answer.selection,
+            Question.answer
+        )
+        .join(Assignment, Answer.assignment_key == Assignment.key)
+        .join(Hit, Assignment.hit_key == Hit.key)
+        .join(Question, Answer.question_key == Question.key)
+        .join(Instance, Question.instance_key == Instance.key)
+        .join(Dataset, Instance.dataset_key == Dataset.key)
+    )
+    if hit_type_keys is not None:
+        query = query.filter(Hit.hit_type_key.in_(hit_type_keys))
+    if statuses:
+        query = query.filter(Assignment.status.in_(statuses))
+    # yield_per streams from a server-side cursor where the driver supports one.
+    return query.order_by(Answer.key).yield_per(batch_size)
+
+
+def to_columns(rows):
+    """Transposes a batch of `response_rows` into column name -> list."""
+    columns = dict(zip(list(COLUMNS)[:-1], (list(column) for column in zip(*rows))))
+    columns['correct'] = [
+        selection == answer for selection, answer in zip(columns['selection'], columns['answer_position'])
+    ]
+    return columns
+
+
+class ArrowWriter:
+    """Appends batches of columns to a Parquet or Arrow IPC file."""
+    def __init__(self, filename, format):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError(
+                f'Exporting to {format} requires pyarrow: pip install pyarrow (or export to a '
+                'directory of .npy columns instead)'
+            )
+        self.pa = pa
+        self.schema = pa.schema([
+            (name, pa.string() if dtype is str else pa.from_numpy_dtype(dtype))
+            for name, dtype in COLUMNS.items()
+        ])
+        if format == 'parquet':
+            self.writer = pq.ParquetWriter(filename, self.schema)
+        else:
+            self.writer = pa.ipc.new_file(filename, self.schema)
+
+    def write(self, columns):
+        batch = self.pa.RecordBatch.from_arrays(
+            [self.pa.array(columns[name], type=field.type) for name, field in zip(COLUMNS, self.schema)],
+            schema=self.schema
+        )
+        if isinstance(self.writer, self.pa.ipc.RecordBatchFileWriter):
+            self.writer.write_batch(batch)
+        else:
+            self.writer.write_table(self.pa.Table.from_batches([batch]))
+
+    def close(self):
+        self.writer.close()
+
+
+class NpyWriter:
+    """
+    Appends batches of columns to a directory of `.npy` files.
+
+    The length of a column isn't known until the last batch, so each is streamed to a raw file
+    and given its `.npy` header on `close`.
+    """
+    def __init__(self, dirname):
+        os.makedirs(dirname, exist_ok=True)
+        self.dirname = dirname
+        self.length = 0
+        self.labels = {name: {} for name, dtype in COLUMNS.items() if dtype is str}
+        self.parts = {name: open(self._path(name) + '.part', 'wb') for name in COLUMNS}
+
+    def _path(self, name, suffix='.npy'):
+        return os.path.join(self.dirname, name + suffix)
+
+    def write(self, columns):
+        for name, values in columns.items():
+            labels = self.labels.get(name)
+            if labels is not None:
+                values = np.fromiter(
+                    (labels.setdefault(value, len(labels)) for value in values),
+                    dtype=np.int32,
+                    count=len(values)
+                )
+            else:
+                values = np.asarray(values, dtype=COLUMNS[name])
+            self.parts[name].write(values.tobytes())
+        self.length += len(columns['correct'])
+
+    def close(self):
+        for name, part in self.parts.items():
+            part.close()
+            dtype = np.dtype(np.int32 if name in self.labels else COLUMNS[name])
+            with open(self._path(name), 'wb') as f, open(part.name, 'rb') as raw:
+                np.lib.format.write_array_header_1_0(f, {
+                    'descr': np.lib.format.dtype_to_descr(dtype),
+                    'fortran_order': False,
+                    'shape': (self.length,),
+                })
+                shutil.copyfileobj(raw, f)
+            os.remove(part.name)
+        for name, labels in self.labels.items():
+            np.save(self._path(name, '.labels.npy'), np.array(list(labels), dtype=str))
+
+
+class Categorical:
+    """A memory-mapped column of codes into `labels`, decoded on indexing."""
+    def __init__(self, codes, labels):
+        self.codes = codes
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, index):
+        return self.labels[self.codes[index]]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.labels[self.codes], dtype=dtype)
+
+    def __eq__(self, value):
+        matches = np.flatnonzero(self.labels == value)
+        return np.isin(self.codes, matches)
+
+
+def open_npy(dirname):
+    """
+    Memory-maps a directory written by `export-results`. Returns column name -> array, with string
+    columns decoded lazily: `columns['worker_id'].codes` and `.labels` hold the raw arrays.
+    """
+    columns = {}
+    for name, dtype in COLUMNS.items():
+        values = np.load(os.path.join(dirname, name + '.npy'), mmap_mode='r')
+        if dtype is str:
+            values = Categorical(values, np.load(os.path.join(dirname, name + '.labels.npy')))
+        columns[name] = values
+    return columns
+
+
+def remove(path):
+    """Removes a partial export."""
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def export_format(output):
+    return FORMATS.get(os.path.splitext(output)[1].lower(), 'npy')
+
+
+@click.command()
+@click.argument('output', type=click.Path())
+@click.option('-t', '--hit-type', 'hit_type_short_names', multiple=True,
+              help='Only export responses to this HIT type (repeatable). Defaults to every HIT type.')
+@click.option('-s', '--status', 'statuses', multiple=True,
+              help='Only export assignments with this status (repeatable), e.g. Submitted or Approved.')
+@click.option('-b', '--batch-size', type=int, default=50000, help='Rows fetched and written at a time.')
+def export_results(output, hit_type_short_names, statuses, batch_size):
+    """
+    Exports every stored response (see sync-assignments) to OUTPUT.
+
+    OUTPUT is written as Parquet if it ends in .parquet, as an Arrow IPC file if it ends in .arrow
+    or .feather, and otherwise as a directory of memory-mappable .npy columns.
+    """
+    if os.path.exists(output):
+        raise FileExistsError(f'{output} already exists')
+    format_ = export_format(output)
+    tmp_output = f'{output}.tmp'
+
+    start = time.perf_counter()
+    count = 0
+    with session_scope() as session:
+        hit_type_keys = None
+        if hit_type_short_names:
+            hit_type_keys = [
+                key for key, in
+                session.query(HitType.key).filter(HitType.short_name.in_(hit_type_short_names))
+            ]
+            if len(hit_type_keys) != len(set(hit_type_short_names)):
+                raise click.BadParameter('Unknown HIT type', param_hint='--hit-type')
+        writer = NpyWriter(tmp_output) if format_ == 'npy' else ArrowWriter(tmp_output, format_)
+        try:
+            for batch in batched(response_rows(session, hit_type_keys, statuses, batch_size), batch_size):
+                writer.write(to_columns(batch))
+                count += len(batch)
+                logger.debug('Exported %i responses', count)
+        except BaseException:
+            writer.close()
+            remove(tmp_output)
+            raise
+        writer.close()
+    os.replace(tmp_output, output)
+    logger.info('Exported %i responses to %s (%s) in %.2fs', count, output, format_,
+                time.perf_counter() - start)
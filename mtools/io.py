@@ -1,9 +1,15 @@
 """
 Utilities and commands for ingesting data into mtools.
 """
+from concurrent.futures import ProcessPoolExecutor
 import hashlib
+import itertools
 import json
 import logging
+import multiprocessing
+import os
+import queue
+import time
 
 import click
 from sqlalchemy.sql import exists
@@ -11,20 +17,29 @@ from sqlalchemy.sql import exists
 from mtools.client import client
 from mtools.db import session_scope
 from mtools.db import Dataset, HitType, Instance, Qualification
+from mtools.db import bulk_insert, content_hash
 
 
 logger = logging.getLogger(__name__)
 
 
-def compute_checksum(filename):
+EVAL_TYPES = ('left', 'right', 'no_context')
+
+
+def compute_checksum(filename, block_size=1 << 20):
+    """The MD5 of a file, read `block_size` bytes at a time so that memory stays bounded."""
     hash_ = hashlib.md5()
     with open(filename, 'rb') as f:
-        hash_.update(f.read())
+        for block in iter(lambda: f.read(block_size), b''):
+            hash_.update(block)
     digest = hash_.hexdigest()
     return digest
 
 
-def create_instance(obj, eval_type):
+def instance_values(obj, eval_type):
+    """
+    Column values for the instance described by a line of a dataset file.
+    """
     sentence_good = obj['sentence_good']
     sentence_bad = obj['sentence_bad']
     if eval_type == 'left':
@@ -33,36 +48,333 @@ def create_instance(obj, eval_type):
     if eval_type == 'right':
         sentence_good = sentence_good + ' ' + obj['right_context']
         sentence_bad = sentence_bad + ' ' + obj['right_context']
-    instance = Instance(
-        sentence_good=sentence_good,
-        sentence_bad=sentence_bad,
-    )
+    return {
+        'sentence_good': sentence_good,
+        'sentence_bad': sentence_bad,
+        'content_hash': content_hash(sentence_good, sentence_bad),
+    }
+
+
+def create_instance(obj, eval_type):
+    instance = Instance(**instance_values(obj, eval_type))
     return instance
 
 
+def read_instances(filename, eval_type, hash_):
+    """
+    Streams instance values out of a JSONL file, feeding every line to `hash_` on the way so that
+    the checksum is computed in the same pass.
+    """
+    with open(filename, 'rb') as f:
+        for line in f:
+            hash_.update(line)
+            if not line.strip():
+                continue
+            yield instance_values(json.loads(line), eval_type)
+
+
+def batched(iterable, batch_size):
+    """Break an iterable into lists of at most batch_size items."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def existing_hashes(session, hashes, dataset_key=None, chunk_size=500):
+    """
+    Returns the subset of `hashes` that are already stored, optionally only within one dataset.
+
+    Uses the index on `instances.content_hash`, so this is cheap even for large tables.
+    """
+    hashes = list(hashes)
+    found = set()
+    for i in range(0, len(hashes), chunk_size):
+        # The dataset is checked here rather than in SQL: given both, SQLite prefers the index on
+        # (dataset_key, asked) and scans the whole dataset for every chunk.
+        query = (
+            session.query(Instance.content_hash, Instance.dataset_key)
+                   .filter(Instance.content_hash.in_(hashes[i:i + chunk_size]))
+        )
+        found.update(x for x, key in query if dataset_key is None or key == dataset_key)
+    return found
+
+
+def insert_instances(session, dataset_key, rows, batch_size, skip_existing=False, skip_duplicates=False):
+    """
+    Bulk inserts instance values in fixed-size batches, bypassing the ORM: with COPY on Postgres,
+    and with executemany elsewhere.
+
+    If `skip_existing` then pairs already in this dataset are not inserted again, and if
+    `skip_duplicates` then neither are pairs already in any dataset.
+
+    Returns the number of rows inserted and the number skipped.
+    """
+    inserted = 0
+    skipped = 0
+    for batch in batched(rows, batch_size):
+        if skip_existing or skip_duplicates:
+            seen = existing_hashes(
+                session,
+                {row['content_hash'] for row in batch},
+                dataset_key=None if skip_duplicates else dataset_key
+            )
+            new_rows = []
+            for row in batch:
+                if row['content_hash'] not in seen:
+                    seen.add(row['content_hash'])
+                    new_rows.append(row)
+            skipped += len(batch) - len(new_rows)
+            batch = new_rows
+        if not batch:
+            continue
+        for row in batch:
+            row['dataset_key'] = dataset_key
+        bulk_insert(session, Instance.__table__, batch)
+        inserted += len(batch)
+    return inserted, skipped
+
+
+def get_or_create_dataset(session, filename, eval_type):
+    """
+    Returns the dataset stored for a file and eval type, adding it if it's new, and whether it was
+    added.
+    """
+    dataset = (
+        session.query(Dataset)
+               .filter(Dataset.filename == filename)
+               .filter(Dataset.eval_type == eval_type)
+               .one_or_none()
+    )
+    if dataset is not None:
+        return dataset, False
+    # Add the dataset first so that instances can reference its key; the checksum is filled in
+    # once the whole file has been read.
+    dataset = Dataset(filename=filename, eval_type=eval_type)
+    session.add(dataset)
+    session.flush()
+    return dataset, True
+
+
+def log_loaded(count, skipped, filename, elapsed):
+    logger.info(
+        'Successfully added %i instances (skipped %i) from "%s" in %.1fs (%.0f rows/sec)',
+        count,
+        skipped,
+        filename,
+        elapsed,
+        count / elapsed if elapsed else 0.0
+    )
+
+
 @click.command()
 @click.argument('filename')
 @click.option('-e', '--eval_type', type=str, required=True)
-def load_dataset(filename, eval_type):
-    assert eval_type in ('left', 'right', 'no_context')
-    # Add the dataset
-    md5sum = compute_checksum(filename)
-    dataset = Dataset(filename=filename, md5sum=md5sum, eval_type=eval_type)
+@click.option('-b', '--batch-size', type=int, default=10000, help='Number of instances per INSERT batch.')
+@click.option('--skip-duplicates/--keep-duplicates', default=False,
+              help='Skip sentence pairs that are already stored under any dataset.')
+def load_dataset(filename, eval_type, batch_size, skip_duplicates):
+    assert eval_type in EVAL_TYPES
+    start = time.monotonic()
+    with session_scope() as session:
+        dataset, created = get_or_create_dataset(session, filename, eval_type)
+        skip_existing = False
+        if not created:
+            if compute_checksum(filename) == dataset.md5sum:
+                logger.info('"%s" is unchanged since it was loaded, skipping', filename)
+                return
+            # Assume the file was appended to, and only add pairs we haven't seen.
+            logger.info('"%s" has changed since it was loaded, adding new instances', filename)
+            skip_existing = True
+
+        # Add the instances
+        hash_ = hashlib.md5()
+        rows = read_instances(filename, eval_type, hash_)
+        count, skipped = insert_instances(
+            session,
+            dataset.key,
+            rows,
+            batch_size,
+            skip_existing=skip_existing,
+            skip_duplicates=skip_duplicates
+        )
+        dataset.md5sum = hash_.hexdigest()
+
+    log_loaded(count, skipped, filename, time.monotonic() - start)
 
-    # Add the instances
+
+def read_manifest(filename):
+    """
+    Reads the (filename, eval_type) entries of a JSON or YAML manifest.
+
+    The manifest is a list of entries, or an object with the list under `datasets`. Each entry is
+    an object with `filename` and `eval_type` keys, or a [filename, eval_type] pair. Environment
+    variables and `~` in filenames are expanded, and relative filenames are taken relative to the
+    manifest.
+    """
     with open(filename, 'r') as f:
-        instances = []
-        for line in f:
-            obj = json.loads(line)
-            instance = create_instance(obj, eval_type)
-            instance.dataset = dataset
-            instances.append(instance)
+        if filename.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError('Reading YAML manifests requires PyYAML: pip install pyyaml')
+            manifest = yaml.safe_load(f)
+        else:
+            manifest = json.load(f)
+    if isinstance(manifest, dict):
+        manifest = manifest['datasets']
+
+    directory = os.path.dirname(filename)
+    entries = []
+    for entry in manifest:
+        if isinstance(entry, dict):
+            dataset_filename, eval_type = entry['filename'], entry['eval_type']
+        else:
+            dataset_filename, eval_type = entry
+        if eval_type not in EVAL_TYPES:
+            raise ValueError(f'Unknown eval_type "{eval_type}" for "{dataset_filename}" in {filename}')
+        dataset_filename = os.path.expanduser(os.path.expandvars(dataset_filename))
+        entries.append((os.path.join(directory, dataset_filename), eval_type))
+    return entries
+
+
+# The queue that `parse_dataset` workers send their batches through, set by `_init_parser`.
+_batches = None
 
+
+def _init_parser(batches):
+    global _batches
+    _batches = batches
+
+
+def parse_dataset(index, filename, eval_type, md5sum=None, batch_size=10000):
+    """
+    Streams the instance values of a dataset file to the parent in batches; run in a worker process.
+
+    Puts (index, rows, None) for each batch of at most `batch_size` rows, then (index, None,
+    checksum) once the file is read. If the file still has checksum `md5sum`, it isn't parsed and
+    only (index, None, None) is put.
+    """
+    if md5sum is not None and compute_checksum(filename) == md5sum:
+        _batches.put((index, None, None))
+        return
+    hash_ = hashlib.md5()
+    for rows in batched(read_instances(filename, eval_type, hash_), batch_size):
+        _batches.put((index, rows, None))
+    _batches.put((index, None, hash_.hexdigest()))
+
+
+def parsed_batches(batches, futures):
+    """
+    Yields what the workers put on `batches` until every file is done, re-raising the error of any
+    worker that fails.
+    """
+    remaining = len(futures)
+    while remaining:
+        try:
+            item = batches.get(timeout=1)
+        except queue.Empty:
+            for future in futures:
+                if future.done() and future.exception() is not None:
+                    raise future.exception()
+            continue
+        if item[1] is None:
+            remaining -= 1
+        yield item
+
+
+@click.command()
+@click.argument('manifest')
+@click.option('-p', '--processes', type=int, default=None,
+              help='Number of processes parsing files; defaults to one per file, up to the number of CPUs.')
+@click.option('-b', '--batch-size', type=int, default=10000, help='Number of instances per INSERT batch.')
+@click.option('--skip-duplicates/--keep-duplicates', default=False,
+              help='Skip sentence pairs that are already stored under any dataset.')
+def load_manifest(manifest, processes, batch_size, skip_duplicates):
+    """
+    Loads every dataset listed in a manifest in one go.
+
+    Files are parsed and hashed in parallel by a pool of processes, which stream their instances
+    back in batches over a bounded queue. This process inserts each batch as it arrives, so memory
+    stays bounded however large the files are.
+    """
+    start = time.monotonic()
+    entries = read_manifest(manifest)
+    processes = max(processes or min(len(entries), os.cpu_count() or 1), 1)
+    total = 0
+    # Manifest index -> progress of the files being loaded.
+    loading = {}
+    batches = multiprocessing.get_context().Queue(maxsize=2 * processes)
     with session_scope() as session:
-        session.add(dataset)
-        session.add_all(instances)
+        checksums = {
+            (filename, eval_type): md5sum for filename, eval_type, md5sum in
+            session.query(Dataset.filename, Dataset.eval_type, Dataset.md5sum)
+        }
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_parser, initargs=(batches,)) as executor:
+            futures = [
+                executor.submit(parse_dataset, index, filename, eval_type, checksums.get((filename, eval_type)),
+                                batch_size)
+                for index, (filename, eval_type) in enumerate(entries)
+            ]
+            try:
+                for index, rows, md5sum in parsed_batches(batches, futures):
+                    filename, eval_type = entries[index]
+                    if index not in loading:
+                        if rows is None and md5sum is None:
+                            logger.info('"%s" is unchanged since it was loaded, skipping', filename)
+                            continue
+                        dataset, created = get_or_create_dataset(session, filename, eval_type)
+                        if not created:
+                            # Assume the file was appended to, and only add pairs we haven't seen.
+                            logger.info('"%s" has changed since it was loaded, adding new instances', filename)
+                        loading[index] = {
+                            'dataset': dataset,
+                            'created': created,
+                            'count': 0,
+                            'skipped': 0,
+                            'start': time.monotonic(),
+                        }
+                    progress = loading[index]
+                    dataset = progress['dataset']
+                    if rows is not None:
+                        count, skipped = insert_instances(
+                            session,
+                            dataset.key,
+                            rows,
+                            batch_size,
+                            skip_existing=not progress['created'],
+                            skip_duplicates=skip_duplicates
+                        )
+                        progress['count'] += count
+                        progress['skipped'] += skipped
+                        continue
+                    # The file is done. Until its checksum is stored, a rerun treats it as changed
+                    # and only adds the instances that are missing.
+                    dataset.md5sum = md5sum
+                    session.commit()
+                    total += progress['count']
+                    elapsed = time.monotonic() - progress['start']
+                    log_loaded(progress['count'], progress['skipped'], filename, elapsed)
+            finally:
+                # Unblock workers still putting batches, so that the pool can shut down.
+                for future in futures:
+                    future.cancel()
+                while not all(future.done() for future in futures):
+                    try:
+                        batches.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
 
-    logger.info('Successfully added data from "%s"', filename)
+    elapsed = time.monotonic() - start
+    logger.info(
+        'Loaded %i instances from %i files in %.1fs (%.0f rows/sec)',
+        total,
+        len(entries),
+        elapsed,
+        total / elapsed if elapsed else 0.0
+    )
 
 
 @click.command()
@@ -0,0 +1,274 @@
+"""
+The launch journal, which makes publishing HITs idempotent and crash-safe.
+
+Every HIT of a prepared batch gets a `LaunchChunk` entry, committed together with the reservation
+of its questions. The entry carries a deterministic `UniqueRequestToken`, which is also sent as the
+HIT's `RequesterAnnotation`. If the process dies between MTurk creating a HIT and the HIT being
+recorded, the entry is left `pending`: sending it again is rejected by MTurk rather than creating
+a duplicate, and the HIT can be found again by its annotation.
+
+MTurk only honours a UniqueRequestToken for 24 hours, so chunks journaled longer ago than that are
+looked up by their annotation before they are sent again.
+"""
+import datetime
+import logging
+import os
+import re
+
+import click
+
+from mtools.client import client
+from mtools.db import naive_utc, session_scope, utcnow
+from mtools.db import Hit, HitType, Instance, LaunchChunk, Question
+from mtools.io import batched
+
+
+logger = logging.getLogger(__name__)
+
+
+PENDING = 'pending'
+PUBLISHED = 'published'
+
+# How long MTurk remembers a UniqueRequestToken, less a margin for clock skew.
+TOKEN_WINDOW = datetime.timedelta(hours=23)
+
+# Error codes MTurk may use to reject a request whose UniqueRequestToken was already used.
+DUPLICATE_ERROR_CODES = {'DuplicateRequest', 'DuplicateRequestException', 'AWS.MechanicalTurk.DuplicateRequest'}
+
+_HIT_ID = re.compile(r'\b([0-9A-Z]{30})\b')
+
+
+def request_token(batch_id, chunk):
+    """The UniqueRequestToken of a chunk; at most 64 characters for a 32 character batch id."""
+    return f'mtools-{batch_id}-{chunk}'
+
+
+def create_entries(session, batch_id, batch_filename, num_chunks):
+    """
+    Journals the chunks of a batch as pending. Returns their keys, in chunk order.
+    """
+    entries = [
+        LaunchChunk(
+            batch_id=batch_id,
+            chunk=chunk,
+            batch_filename=batch_filename,
+            unique_request_token=request_token(batch_id, chunk),
+            state=PENDING,
+        )
+        for chunk in range(num_chunks)
+    ]
+    session.add_all(entries)
+    session.flush()  # So the keys exist
+    return [entry.key for entry in entries]
+
+
+def pending_entries(session, batch_id):
+    """
+    Maps chunk index -> (key, token) of the pending chunks of a batch.
+    """
+    query = (
+        session.query(LaunchChunk.chunk, LaunchChunk.key, LaunchChunk.unique_request_token)
+               .filter(LaunchChunk.batch_id == batch_id)
+               .filter(LaunchChunk.state == PENDING)
+    )
+    return {chunk: (key, token) for chunk, key, token in query}
+
+
+def stale_entries(session, batch_id):
+    """
+    The (key, token) pairs of the pending chunks of a batch that were journaled before MTurk's
+    token window, and so may have been launched without MTurk still catching a repeat.
+    """
+    query = (
+        session.query(LaunchChunk.key, LaunchChunk.unique_request_token)
+               .filter(LaunchChunk.batch_id == batch_id)
+               .filter(LaunchChunk.state == PENDING)
+               .filter((LaunchChunk.created_at == None) | (LaunchChunk.created_at < utcnow() - TOKEN_WINDOW))
+    )
+    return query.all()
+
+
+def record_launch(session, launch_chunk_key, hit_type_key, hit):
+    """
+    Records a launched HIT, links its questions to it and marks its chunk published.
+
+    Commits immediately since we never want to rollback successful launches.
+    """
+    record = Hit(
+        hit_id=hit['HITId'],
+        hit_type_key=hit_type_key,
+        max_assignments=hit.get('MaxAssignments'),
+        expiration=naive_utc(hit.get('Expiration'))
+    )
+    session.add(record)
+    session.flush()
+    (
+        session.query(Question)
+               .filter(Question.launch_chunk_key == launch_chunk_key)
+               .update({Question.hit_key: record.key}, synchronize_session=False)
+    )
+    (
+        session.query(LaunchChunk)
+               .filter(LaunchChunk.key == launch_chunk_key)
+               .update({LaunchChunk.state: PUBLISHED, LaunchChunk.hit_key: record.key},
+                       synchronize_session=False)
+    )
+    session.commit()
+
+
+def is_duplicate_request_error(exc):
+    """Whether MTurk rejected a request because its UniqueRequestToken was already used."""
+    response = getattr(exc, 'response', None)
+    if not isinstance(response, dict):
+        return False
+    error = response.get('Error', {})
+    if error.get('Code') in DUPLICATE_ERROR_CODES:
+        return True
+    # Otherwise MTurk reports a RequestError saying the UniqueRequestToken was already used.
+    message = error.get('Message', '').lower()
+    return 'uniquerequesttoken' in message and 'already' in message
+
+
+def duplicate_hit_id(exc):
+    """The id of the existing HIT, if MTurk names it when rejecting a duplicate request."""
+    message = exc.response.get('Error', {}).get('Message', '')
+    match = _HIT_ID.search(message)
+    return match.group(1) if match else None
+
+
+def recover_duplicates(session, hit_type_key, duplicates):
+    """
+    Records the HITs behind requests MTurk rejected as duplicates of earlier, unrecorded ones.
+
+    `duplicates` are (key, token, hit id or None) triples. Returns the (key, token) pairs whose HIT
+    couldn't be found.
+    """
+    unnamed = []
+    for key, token, hit_id in duplicates:
+        if hit_id is None:
+            unnamed.append((key, token))
+            continue
+        logger.info('Recovered HIT %s for %s', hit_id, token)
+        record_launch(session, key, hit_type_key, client.get_hit(HITId=hit_id)['HIT'])
+    return reconcile(session, unnamed)
+
+
+def launched_hits(tokens):
+    """
+    Finds HITs on MTurk whose RequesterAnnotation is one of `tokens`. Returns token -> HIT.
+    """
+    tokens = set(tokens)
+    found = {}
+    paginator = client.get_paginator('list_hits')
+    for page in paginator.paginate(PaginationConfig={'PageSize': 100}):
+        for hit in page['HITs']:
+            token = hit.get('RequesterAnnotation')
+            if token in tokens:
+                found[token] = hit
+        if len(found) == len(tokens):
+            break
+    return found
+
+
+def reconcile(session, entries):
+    """
+    Records the HITs that MTurk launched for pending journal entries but we never recorded.
+
+    `entries` are (key, token) pairs. Returns the pairs that MTurk has no HIT for.
+    """
+    entries = list(entries)
+    if not entries:
+        return []
+    found = launched_hits(token for _, token in entries)
+    hit_type_keys = dict(session.query(HitType.hit_type_id, HitType.key))
+    missing = []
+    for key, token in entries:
+        hit = found.get(token)
+        if hit is None:
+            missing.append((key, token))
+            continue
+        logger.info('Recovered HIT %s for %s', hit['HITId'], token)
+        record_launch(session, key, hit_type_keys.get(hit['HITTypeId']), hit)
+    return missing
+
+
+def release(session, launch_chunk_keys, chunk_size=500):
+    """
+    Abandons pending journal entries: deletes their questions and returns their instances to the
+    pool of unasked instances.
+    """
+    launch_chunk_keys = list(launch_chunk_keys)
+    for keys in batched(launch_chunk_keys, chunk_size):
+        questions = session.query(Question).filter(Question.launch_chunk_key.in_(keys))
+        instance_keys = [key for key, in questions.with_entities(Question.instance_key)]
+        for instance_keys_ in batched(instance_keys, chunk_size):
+            (
+                session.query(Instance)
+                       .filter(Instance.key.in_(instance_keys_))
+                       .update({Instance.asked: False}, synchronize_session=False)
+            )
+        questions.delete(synchronize_session=False)
+        (
+            session.query(LaunchChunk)
+                   .filter(LaunchChunk.key.in_(keys))
+                   .delete(synchronize_session=False)
+        )
+    session.commit()
+
+
+def release_orphaned_questions(session):
+    """
+    Deletes questions reserved by deploys that predate the journal but never linked to a HIT, and
+    returns their instances to the pool. Returns the number of questions released.
+    """
+    orphaned = (
+        session.query(Question)
+               .filter(Question.hit_key == None)
+               .filter(Question.launch_chunk_key == None)
+    )
+    instance_keys = [key for key, in orphaned.with_entities(Question.instance_key)]
+    for keys in batched(instance_keys, 500):
+        (
+            session.query(Instance)
+                   .filter(Instance.key.in_(keys))
+                   .update({Instance.asked: False}, synchronize_session=False)
+        )
+    count = orphaned.delete(synchronize_session=False)
+    session.commit()
+    return count
+
+
+@click.command()
+@click.option('--release/--no-release', 'release_', default=False,
+              help='Abandon pending chunks that MTurk never launched, freeing their instances.')
+def recover_launches(release_):
+    """
+    Reconciles the launch journal with MTurk.
+
+    HITs that were launched but never recorded are recorded. Pending chunks that MTurk never
+    launched are listed by batch, to be resumed with `publish`, or abandoned with `--release`.
+    """
+    with session_scope() as session:
+        pending = (
+            session.query(LaunchChunk.key, LaunchChunk.unique_request_token, LaunchChunk.batch_filename)
+                   .filter(LaunchChunk.state == PENDING)
+                   .all()
+        )
+        logger.info('Found %i pending chunks', len(pending))
+        filenames = {key: filename for key, _, filename in pending}
+        missing = reconcile(session, [(key, token) for key, token, _ in pending])
+        logger.info('Recovered %i HITs', len(pending) - len(missing))
+
+        if release_:
+            release(session, [key for key, _ in missing])
+            logger.info('Released %i chunks', len(missing))
+            count = release_orphaned_questions(session)
+            if count:
+                logger.info('Released %i questions never linked to a HIT or chunk', count)
+        else:
+            by_batch = {}
+            for key, _ in missing:
+                by_batch[filenames[key]] = by_batch.get(filenames[key], 0) + 1
+            for filename, count in sorted(by_batch.items()):
+                hint = '' if os.path.exists(filename) else ' (batch file missing; use --release)'
+                logger.info('%i chunks of %s were never launched%s', count, filename, hint)
@@ -0,0 +1,231 @@
+"""
+Bulk expiry, extension and deletion of launched HITs.
+
+HITs are picked from the local `hits` table by HIT type and/or dataset, the calls are fanned out
+over a rate-limited pool of workers, and each HIT's new lifecycle state is recorded locally as
+its call succeeds.
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import datetime
+import logging
+import time
+
+import click
+
+from mtools.client import check_concurrency, client_for
+from mtools.db import naive_utc, session_scope
+from mtools.db import Dataset, Hit, HitType, Instance, Question
+from mtools.throttle import TokenBucket, call_with_backoff
+
+
+logger = logging.getLogger(__name__)
+
+
+ACTIVE = 'active'
+EXPIRED = 'expired'
+# All assignments approved by accept-all, and no more to come.
+REVIEWED = 'reviewed'
+DELETED = 'deleted'
+
+# Setting a HIT's expiration to any time in the past expires it immediately.
+EXPIRE_AT = datetime.datetime(2015, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def select_hits(session, hit_type_short_names=(), datasets=(), statuses=None):
+    """
+    The HITs of any of the given HIT types that ask questions from any of the given datasets
+    (filenames, as loaded), optionally only those in one of `statuses`.
+    """
+    query = session.query(Hit)
+    if hit_type_short_names:
+        hit_type_keys = [
+            key for key, in
+            session.query(HitType.key).filter(HitType.short_name.in_(hit_type_short_names))
+        ]
+        if len(hit_type_keys) != len(set(hit_type_short_names)):
+            raise click.BadParameter('Unknown HIT type', param_hint='HIT_TYPE_SHORT_NAMES')
+        query = query.filter(Hit.hit_type_key.in_(hit_type_keys))
+    if datasets:
+        hit_keys = (
+            session.query(Question.hit_key)
+                   .join(Instance, Question.instance_key == Instance.key)
+                   .join(Dataset, Instance.dataset_key == Dataset.key)
+                   .filter(Dataset.filename.in_(datasets))
+        )
+        query = query.filter(Hit.key.in_(hit_keys))
+    if statuses is not None:
+        query = query.filter(Hit.status.in_(statuses))
+    return query.order_by(Hit.key).all()
+
+
+def is_missing_hit_error(exc):
+    """Whether MTurk rejected a call because the HIT doesn't exist (e.g. it was already deleted)."""
+    response = getattr(exc, 'response', None)
+    if not isinstance(response, dict):
+        return False
+    return 'does not exist' in response.get('Error', {}).get('Message', '').lower()
+
+
+def apply_to_hits(session, hits, operation, record, workers=8, max_rps=None, commit_every=500,
+                  **kwargs):
+    """
+    Makes the client call `operation(HITId=..., **kwargs)` for every HIT concurrently.
+    `record(hit, error)` is called on the main thread with each outcome (`error` is None on
+    success) to update the HIT, and returns whether the HIT is done. Changes are committed every
+    `commit_every` HITs, so an interrupted run loses little. Returns the number of HITs done.
+    """
+    if not hits:
+        return 0
+    limiter = TokenBucket(max_rps) if max_rps else None
+    call = getattr(client_for(limiter), operation)
+    check_concurrency(workers)
+    succeeded = 0
+    failed = 0
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(call_with_backoff, limiter, call, HITId=hit.hit_id, **kwargs): hit
+            for hit in hits
+        }
+        try:
+            for future in as_completed(futures):
+                hit = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    if not record(hit, e):
+                        failed += 1
+                        logger.error('Failed to update HIT %s: %s', hit.hit_id, e)
+                        continue
+                else:
+                    record(hit, None)
+                succeeded += 1
+                if succeeded % commit_every == 0:
+                    session.commit()
+        finally:
+            for future in futures:
+                future.cancel()
+            session.commit()
+    elapsed = time.monotonic() - start
+    logger.info(
+        'Updated %i HITs in %.1fs (%.2f HITs/sec); failed %i',
+        succeeded,
+        elapsed,
+        succeeded / elapsed if elapsed else 0.0,
+        failed
+    )
+    return succeeded
+
+
+def expire_all(session, hits, **kwargs):
+    """Expires HITs immediately, so that workers can no longer accept them."""
+    def expired(hit, error):
+        if error is not None and not is_missing_hit_error(error):
+            return False
+        hit.status = DELETED if error is not None else EXPIRED
+        hit.expiration = naive_utc(EXPIRE_AT)
+        return True
+
+    return apply_to_hits(session, hits, 'update_expiration_for_hit', expired, ExpireAt=EXPIRE_AT, **kwargs)
+
+
+def extend_all(session, hits, expire_at, **kwargs):
+    """Moves the expiration of HITs to `expire_at`, re-opening expired HITs."""
+    def extended(hit, error):
+        if error is not None:
+            return False
+        hit.status = ACTIVE
+        hit.expiration = naive_utc(expire_at)
+        return True
+
+    return apply_to_hits(session, hits, 'update_expiration_for_hit', extended, ExpireAt=expire_at, **kwargs)
+
+
+def delete_all(session, hits, **kwargs):
+    """
+    Deletes HITs. MTurk only deletes HITs that have expired and whose submitted assignments have
+    all been approved or rejected; other HITs fail and are left as they are.
+    """
+    def deleted(hit, error):
+        if error is not None and not is_missing_hit_error(error):
+            return False
+        hit.status = DELETED
+        return True
+
+    return apply_to_hits(session, hits, 'delete_hit', deleted, **kwargs)
+
+
+def hit_options(command):
+    """Options shared by the lifecycle commands for picking HITs and pacing calls."""
+    options = [
+        click.argument('hit_type_short_names', nargs=-1),
+        click.option('-d', '--dataset', 'datasets', multiple=True,
+                     help='Only HITs asking questions from this dataset file (repeatable).'),
+        click.option('--dry-run', is_flag=True, default=False, help='Only report which HITs would be changed.'),
+        click.option('-w', '--workers', type=int, default=8, help='Number of concurrent API calls.'),
+        click.option('--max-rps', type=float, default=None, help='Shared limit on API calls per second.'),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def _select(session, hit_type_short_names, datasets, statuses, dry_run, action):
+    if not hit_type_short_names and not datasets:
+        raise click.UsageError('Give at least one HIT type or --dataset')
+    hits = select_hits(session, hit_type_short_names, datasets, statuses)
+    logger.info('Selected %i HITs to %s', len(hits), action)
+    if dry_run:
+        for hit in hits:
+            logger.info('Would %s HIT %s', action, hit.hit_id)
+    return hits
+
+
+@click.command()
+@hit_options
+def expire_hits(hit_type_short_names, datasets, dry_run, workers, max_rps):
+    """
+    Expires the active (or reviewed) HITs of the given HIT types and/or datasets.
+
+    Workers can no longer accept them; assignments already accepted can still be submitted.
+    """
+    with session_scope() as session:
+        hits = _select(session, hit_type_short_names, datasets, [ACTIVE, REVIEWED], dry_run, 'expire')
+        if not dry_run:
+            expire_all(session, hits, workers=workers, max_rps=max_rps)
+
+
+@click.command()
+@hit_options
+@click.option('--lifetime_in_seconds', type=int, default=604800,  # Default: 1 week
+              help='New lifetime of the HITs, from now.')
+def extend_hits(hit_type_short_names, datasets, dry_run, workers, max_rps, lifetime_in_seconds):
+    """
+    Extends the lifetime of the HITs of the given HIT types and/or datasets, re-opening expired
+    ones. Reviewed HITs become active again, so that accept-all approves their new work.
+    """
+    expire_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=lifetime_in_seconds)
+    with session_scope() as session:
+        hits = _select(session, hit_type_short_names, datasets, [ACTIVE, EXPIRED, REVIEWED], dry_run, 'extend')
+        if not dry_run:
+            extend_all(session, hits, expire_at, workers=workers, max_rps=max_rps)
+
+
+@click.command()
+@hit_options
+@click.option('--expire/--no-expire', default=True, help='Expire active and reviewed HITs first.')
+def delete_hits(hit_type_short_names, datasets, dry_run, workers, max_rps, expire):
+    """
+    Deletes the HITs of the given HIT types and/or datasets.
+
+    Only expired HITs whose submitted assignments have all been approved or rejected can be
+    deleted; run accept-all first.
+    """
+    with session_scope() as session:
+        hits = _select(session, hit_type_short_names, datasets, [ACTIVE, EXPIRED, REVIEWED], dry_run, 'delete')
+        if dry_run:
+            return
+        if expire:
+            to_expire = [hit for hit in hits if hit.status in (ACTIVE, REVIEWED)]
+            expire_all(session, to_expire, workers=workers, max_rps=max_rps)
+        delete_all(session, [hit for hit in hits if hit.status != DELETED], workers=workers, max_rps=max_rps)
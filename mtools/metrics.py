@@ -0,0 +1,298 @@
+"""
+Opt-in instrumentation of MTurk API calls and database queries.
+
+`enable` turns on a process-wide `Metrics` registry. The client and engine are instrumented when
+they are created: botocore event hooks time every API call and count retries and throttled
+attempts, and SQLAlchemy engine events time every query. The registry can be summarized for
+humans or dumped as JSON or in the Prometheus text exposition format.
+"""
+from collections import defaultdict
+import json
+import logging
+import os
+import threading
+import time
+
+from mtools.throttle import is_throttling_response
+
+
+logger = logging.getLogger(__name__)
+
+
+# Upper bounds of the latency histogram buckets, in seconds (the Prometheus client defaults).
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+_CONTEXT_KEY = 'mtools_start'
+
+
+class Histogram:
+    """Counts of observations falling into each of `LATENCY_BUCKETS`."""
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """An upper bound on the q-th quantile: the bound of the bucket containing it."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            'buckets': {_format_bound(b): c for b, c in zip(LATENCY_BUCKETS, self.counts)},
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+        }
+
+
+def _format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+class Metrics:
+    """
+    Thread-safe registry of API and database measurements.
+
+    API calls are keyed by operation name. `retries` counts attempts botocore made beyond the first,
+    `throttles` counts attempts (including retried ones) that MTurk throttled, and `errors` counts
+    calls that ultimately failed. Queries are keyed by statement type (select, insert, ...).
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.command = None
+        self.api_calls = defaultdict(int)
+        self.api_errors = defaultdict(int)
+        self.api_retries = defaultdict(int)
+        self.api_throttles = defaultdict(int)
+        self.api_latency = defaultdict(Histogram)
+        self.db_queries = defaultdict(int)
+        self.db_seconds = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def observe_call(self, operation, seconds, retries=0, error=False):
+        with self._lock:
+            self.api_calls[operation] += 1
+            self.api_latency[operation].observe(seconds)
+            self.api_retries[operation] += retries
+            if error:
+                self.api_errors[operation] += 1
+
+    def observe_throttle(self, operation):
+        with self._lock:
+            self.api_throttles[operation] += 1
+
+    def observe_query(self, statement, seconds):
+        with self._lock:
+            self.db_queries[statement] += 1
+            self.db_seconds[statement] += seconds
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'command': self.command,
+                'wall_seconds': time.perf_counter() - self.start,
+                'api': {
+                    operation: {
+                        'calls': self.api_calls[operation],
+                        'errors': self.api_errors[operation],
+                        'retries': self.api_retries[operation],
+                        'throttles': self.api_throttles[operation],
+                        'latency_seconds': self.api_latency[operation].to_dict(),
+                    }
+                    for operation in sorted(set(self.api_calls) | set(self.api_throttles))
+                },
+                'db': {
+                    statement: {
+                        'queries': self.db_queries[statement],
+                        'seconds': self.db_seconds[statement],
+                    }
+                    for statement in sorted(self.db_queries)
+                },
+            }
+
+    def to_prometheus(self):
+        """Renders the metrics in the Prometheus text format, e.g. for node_exporter's textfile collector."""
+        data = self.to_dict()
+        labels = f'command="{data["command"] or ""}"'
+        lines = []
+
+        def metric(name, kind, help_, samples):
+            lines.append(f'# HELP {name} {help_}')
+            lines.append(f'# TYPE {name} {kind}')
+            for suffix, extra, value in samples:
+                label_set = ','.join(x for x in (labels, extra) if x)
+                lines.append(f'{name}{suffix}{{{label_set}}} {value}')
+
+        api = data['api']
+        for field, help_ in (
+            ('calls', 'MTurk API calls.'),
+            ('errors', 'MTurk API calls that failed.'),
+            ('retries', 'MTurk API attempts retried by botocore.'),
+            ('throttles', 'MTurk API attempts that were throttled.'),
+        ):
+            metric(
+                f'mtools_api_{field}_total', 'counter', help_,
+                [('', f'operation="{op}"', values[field]) for op, values in api.items()]
+            )
+
+        samples = []
+        for op, values in api.items():
+            histogram = values['latency_seconds']
+            cumulative = 0
+            for bound, count in histogram['buckets'].items():
+                cumulative += count
+                samples.append(('_bucket', f'operation="{op}",le="{bound}"', cumulative))
+            samples.append(('_sum', f'operation="{op}"', histogram['sum']))
+            samples.append(('_count', f'operation="{op}"', histogram['count']))
+        metric('mtools_api_latency_seconds', 'histogram', 'MTurk API call latency.', samples)
+
+        db = data['db']
+        metric(
+            'mtools_db_queries_total', 'counter', 'Database queries.',
+            [('', f'statement="{s}"', values['queries']) for s, values in db.items()]
+        )
+        metric(
+            'mtools_db_query_seconds_total', 'counter', 'Time spent executing database queries.',
+            [('', f'statement="{s}"', values['seconds']) for s, values in db.items()]
+        )
+        metric(
+            'mtools_command_duration_seconds', 'gauge', 'Wall time of the command.',
+            [('', '', data['wall_seconds'])]
+        )
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """A human-readable table of the metrics."""
+        data = self.to_dict()
+        lines = [f'Profile of {data["command"] or "command"}: {data["wall_seconds"]:.2f}s wall time']
+        if data['api']:
+            lines.append(
+                f'  {"operation":<32} {"calls":>7} {"errors":>7} {"retries":>8} {"throttled":>10} '
+                f'{"total s":>9} {"mean ms":>8} {"p95 ms":>8} {"max ms":>8}'
+            )
+            for op, values in data['api'].items():
+                histogram = self.api_latency[op]
+                mean = histogram.sum / histogram.count if histogram.count else 0.0
+                lines.append(
+                    f'  {op:<32} {values["calls"]:7d} {values["errors"]:7d} {values["retries"]:8d} '
+                    f'{values["throttles"]:10d} {histogram.sum:9.2f} {1000 * mean:8.1f} '
+                    f'{1000 * histogram.quantile(0.95):8.1f} {1000 * histogram.max:8.1f}'
+                )
+        if data['db']:
+            lines.append(f'  {"statement":<32} {"queries":>7} {"total s":>9}')
+            for statement, values in data['db'].items():
+                lines.append(f'  {statement:<32} {values["queries"]:7d} {values["seconds"]:9.2f}')
+        return '\n'.join(lines)
+
+    def write(self, filename):
+        """
+        Dumps the metrics to `filename`: Prometheus text format if it ends in `.prom`, else JSON.
+
+        The file is replaced atomically, so collectors never read a partial dump.
+        """
+        if filename.endswith('.prom'):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.to_dict(), indent=2) + '\n'
+        tmp_filename = f'{filename}.tmp'
+        with open(tmp_filename, 'w') as f:
+            f.write(content)
+        os.replace(tmp_filename, filename)
+
+
+_metrics = None
+
+
+def enable():
+    """Turns on instrumentation of clients and engines created from now on."""
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
+
+
+def get_metrics():
+    """The enabled registry, or None if instrumentation is off."""
+    return _metrics
+
+
+def instrument_client(client):
+    """Registers botocore event handlers that record every call made with `client`."""
+    metrics = get_metrics()
+    if metrics is None:
+        return client
+    events = client.meta.events
+    service = client.meta.service_model.service_id.hyphenize()
+
+    def before_call(model, context, **kwargs):
+        context[_CONTEXT_KEY] = time.perf_counter()
+
+    def after_call(model, parsed, context, **kwargs):
+        start = context.pop(_CONTEXT_KEY, None)
+        if start is None:
+            return
+        retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        metrics.observe_call(model.name, time.perf_counter() - start, retries, error='Error' in parsed)
+
+    def after_call_error(context, event_name, **kwargs):
+        # Only emitted for failures without a response, e.g. connection errors.
+        start = context.pop(_CONTEXT_KEY, None)
+        if start is not None:
+            operation = event_name.rsplit('.', 1)[-1]
+            metrics.observe_call(operation, time.perf_counter() - start, error=True)
+
+    def needs_retry(response, operation, **kwargs):
+        # Emitted after every attempt, so this also sees throttles that botocore retried away.
+        if response is not None and is_throttling_response(response[1]):
+            metrics.observe_throttle(operation.name)
+
+    events.register(f'before-call.{service}', before_call)
+    events.register(f'after-call.{service}', after_call)
+    events.register(f'after-call-error.{service}', after_call_error)
+    events.register(f'needs-retry.{service}', needs_retry)
+    return client
+
+
+def instrument_engine(engine):
+    """Registers SQLAlchemy event handlers that record every query run on `engine`."""
+    metrics = get_metrics()
+    if metrics is None:
+        return engine
+    from sqlalchemy import event
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault(_CONTEXT_KEY, []).append(time.perf_counter())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info[_CONTEXT_KEY].pop()
+        kind = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else 'other'
+        metrics.observe_query(kind, time.perf_counter() - start)
+
+    def handle_error(exception_context):
+        conn = exception_context.connection
+        if conn is not None and conn.info.get(_CONTEXT_KEY):
+            conn.info[_CONTEXT_KEY].pop()
+            metrics.observe_query('error', 0.0)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+    event.listen(engine, 'handle_error', handle_error)
+    return engine
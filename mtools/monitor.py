@@ -0,0 +1,178 @@
+"""
+Online worker-quality monitoring and qualification enforcement.
+"""
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
+
+from mtools.client import client, client_for
+from mtools.db import Qualification
+from mtools.throttle import TokenBucket, call_with_backoff
+
+
+logger = logging.getLogger(__name__)
+
+
+NO_VARIABILITY = 'no variability in answers'
+
+
+class WorkerMonitor:
+    """
+    Scores assignments as they arrive and flags workers that look like spammers.
+
+    An assignment is suspicious if every answer is the same choice, if it was completed faster than
+    `min_seconds_per_question` allows, or if (once a worker has at least `min_responses` answers)
+    the worker agrees with the gold answer - or the running majority, for questions without one -
+    less than `min_agreement` of the time.
+    """
+    def __init__(self, answer_key, min_seconds_per_question=2.0, min_agreement=0.6, min_responses=10):
+        self.answer_key = answer_key
+        self.min_seconds_per_question = min_seconds_per_question
+        self.min_agreement = min_agreement
+        self.min_responses = min_responses
+        self.flagged = {}
+        self._label_counts = defaultdict(Counter)
+        self._responses = Counter()
+        self._agreed = Counter()
+
+    def _reference(self, question_key):
+        gold = self.answer_key.get(question_key)
+        if gold is not None:
+            return gold[0]
+        counts = self._label_counts[question_key]
+        if counts:
+            return counts.most_common(1)[0][0]
+        return None
+
+    def observe(self, assignment, answers):
+        """
+        Scores one assignment, returning a list of reasons not to trust it (empty if there are none).
+        """
+        worker_id = assignment['WorkerId']
+        reasons = []
+        if len(answers) > 1 and len({selection for _, selection in answers}) == 1:
+            reasons.append(NO_VARIABILITY)
+
+        accept_time = assignment.get('AcceptTime')
+        submit_time = assignment.get('SubmitTime')
+        if accept_time is not None and submit_time is not None:
+            elapsed = (submit_time - accept_time).total_seconds()
+            if elapsed < self.min_seconds_per_question * len(answers):
+                reasons.append(f'completed {len(answers)} questions in {elapsed:.0f}s')
+
+        for question_key, selection in answers:
+            reference = self._reference(question_key)
+            if reference is not None:
+                self._responses[worker_id] += 1
+                self._agreed[worker_id] += selection == reference
+            self._label_counts[question_key][selection] += 1
+        responses = self._responses[worker_id]
+        if responses >= self.min_responses:
+            agreement = self._agreed[worker_id] / responses
+            if agreement < self.min_agreement:
+                reasons.append(f'agreement of {agreement:.2f} over {responses} answers')
+
+        if reasons and worker_id not in self.flagged:
+            logger.info('Flagging worker %s: %s', worker_id, '; '.join(reasons))
+            self.flagged[worker_id] = reasons
+        return reasons
+
+    def is_flagged(self, worker_id):
+        return worker_id in self.flagged
+
+
+def qualification_type_id(session, short_name):
+    """Looks up the MTurk id of a qualification created with `create-qualification`."""
+    qualification = (
+        session.query(Qualification)
+               .filter(Qualification.short_name == short_name)
+               .one()
+    )
+    return qualification.qualification_type_id
+
+
+def qualified_workers(qualification_type_id):
+    """The ids of workers that already hold a qualification."""
+    paginator = client.get_paginator('list_workers_with_qualification_type')
+    workers = set()
+    for page in paginator.paginate(QualificationTypeId=qualification_type_id, Status='Granted'):
+        workers.update(x['WorkerId'] for x in page['Qualifications'])
+    return workers
+
+
+class QualificationEnforcer:
+    """
+    Grants a qualification (e.g. `bad-worker`) to flagged workers in concurrent batches.
+
+    Workers are deduplicated, including against those who already hold the qualification. Batches
+    are pushed in the background as soon as `batch_size` workers are waiting or `interval` seconds
+    have passed, so bad workers are locked out while results are still streaming in. Use as a
+    context manager, or call `close` to push the rest and wait.
+    """
+    def __init__(self, qualification_type_id, workers=8, max_rps=None, batch_size=20, interval=30.0,
+                 integer_value=1):
+        self.qualification_type_id = qualification_type_id
+        self.batch_size = batch_size
+        self.interval = interval
+        self.integer_value = integer_value
+        self.limiter = TokenBucket(max_rps) if max_rps else None
+        self.granted = 0
+        self.failed = 0
+        self._seen = qualified_workers(qualification_type_id)
+        self._pending = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        logger.info('%i workers already hold qualification %s', len(self._seen), qualification_type_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def flag(self, worker_id):
+        if worker_id in self._seen:
+            return
+        self._seen.add(worker_id)
+        self._pending.append(worker_id)
+        self.poll()
+
+    def poll(self):
+        """Flush if a full batch is waiting or the interval has passed since the last flush."""
+        if len(self._pending) >= self.batch_size or time.monotonic() - self._last_flush >= self.interval:
+            self.flush()
+
+    def _grant(self, worker_id):
+        try:
+            call_with_backoff(
+                self.limiter,
+                client_for(self.limiter).associate_qualification_with_worker,
+                QualificationTypeId=self.qualification_type_id,
+                WorkerId=worker_id,
+                IntegerValue=self.integer_value,
+                SendNotification=False
+            )
+        except Exception as e:
+            logger.error('Failed to qualify worker %s: %s', worker_id, e)
+            with self._lock:
+                self.failed += 1
+        else:
+            with self._lock:
+                self.granted += 1
+
+    def flush(self):
+        """Start pushing every waiting worker, without waiting for the calls to finish."""
+        if self._pending:
+            logger.info('Qualifying %i workers', len(self._pending))
+        for worker_id in self._pending:
+            self._executor.submit(self._grant, worker_id)
+        self._pending = []
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self._executor.shutdown(wait=True)
+        logger.info('Qualified %i workers (%i failed)', self.granted, self.failed)
@@ -1,33 +1,203 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import datetime
 import logging
+import time
 
 import click
+from sqlalchemy import bindparam
 
-from mtools.client import client
+from mtools.client import check_concurrency, client_for
+from mtools.db import session_scope, utcnow
+from mtools.db import ApprovedAssignment, Assignment, Hit
+from mtools.evaluate import submitted_assignments
+from mtools.io import batched
+from mtools.lifecycle import ACTIVE, EXPIRED, REVIEWED, hit_options, select_hits
+from mtools.throttle import TokenBucket, call_with_backoff, is_throttling_error
 
 
 logger = logging.getLogger(__name__)
 
 
+# Marks a locally stored assignment approved, alongside its checkpoint.
+_approve = (
+    Assignment.__table__.update()
+              .where(Assignment.__table__.c.assignment_id == bindparam('approved_id'))
+              .values(status='Approved', approval_time=bindparam('approved_at'))
+)
+
+
+def review_state(hit):
+    """
+    Reads how many of a HIT's assignments await review off a `get_hit` response, and whether the
+    HIT can still receive new ones.
+    """
+    pending = hit.get('NumberOfAssignmentsPending', 0)
+    available = hit.get('NumberOfAssignmentsAvailable', 0)
+    completed = hit.get('NumberOfAssignmentsCompleted', 0)
+    expiration = hit.get('Expiration')
+    expired = expiration is not None and expiration <= datetime.datetime.now(expiration.tzinfo)
+    submitted = hit['MaxAssignments'] - pending - available - completed
+    return submitted, pending == 0 and (available == 0 or expired)
+
+
+def hits_to_review(hit_ids, states, workers=4, limiter=None):
+    """
+    Looks up pending HITs concurrently, yielding the ids of those with submitted assignments to
+    review as their lookups return. Fills `states` with HIT id -> whether the HIT can still
+    receive new assignments.
+    """
+    def get_hit(hit_id):
+        try:
+            return call_with_backoff(limiter, client_for(limiter).get_hit, HITId=hit_id)['HIT']
+        except Exception as e:
+            logger.error('Failed to get HIT %s: %s', hit_id, e)
+            return None
+
+    # Keep a bounded number of lookups in flight, so that a large backlog of HITs isn't all
+    # submitted up front; HITs are yielded as their lookups return.
+    pending = {}
+
+    def drain(return_when):
+        done, _ = wait(pending, return_when=return_when)
+        for future in done:
+            hit_id = pending.pop(future)
+            hit = future.result()
+            if hit is None:
+                continue
+            submitted, finished = review_state(hit)
+            states[hit_id] = finished
+            if submitted > 0:
+                yield hit_id
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for hit_id in hit_ids:
+                pending[executor.submit(get_hit, hit_id)] = hit_id
+                if len(pending) >= 2 * workers:
+                    yield from drain(FIRST_COMPLETED)
+            while pending:
+                yield from drain(FIRST_COMPLETED)
+        finally:
+            for future in pending:
+                future.cancel()
+
+
 @click.command()
-def accept_all():
-    logger.info('Accepting all submitted HITs')
-    reviewable_hit_paginator = client.get_paginator('list_reviewable_hits')
-    assignment_paginator = client.get_paginator('list_assignments_for_hit')
-    for reviewable_hits in reviewable_hit_paginator.paginate():
-        for hit in reviewable_hits['HITs']:
-            hit_id = hit['HITId']
-            iterable = assignment_paginator.paginate(
-                HITId=hit_id,
-                AssignmentStatuses=['Submitted']
-            )
-            for assignments in iterable:
-                for assignment in assignments['Assignments']:
-                    assignment_id = assignment['AssignmentId']
-                    logger.info(f'Approving assignment: {assignment_id}')
-                    response = client.approve_assignment(AssignmentId=assignment_id)
-                    logger.info(f'Response: {response}')
+@hit_options
+@click.option('--list-workers', type=int, default=4, help='Number of concurrent get_hit and list calls.')
+@click.option('--commit-every', type=int, default=100, help='Checkpoint approvals to the DB this often.')
+def accept_all(hit_type_short_names, datasets, dry_run, workers, max_rps, list_workers, commit_every):
+    """
+    Approves the submitted assignments of the HITs launched by mtools, optionally only those of the
+    given HIT types and/or datasets.
+
+    Only HITs that may still have assignments to review are looked up. Approved assignments that
+    are stored locally (see sync-assignments) are marked approved. Once a HIT's assignments have
+    all been approved and it can't receive new ones, it is marked reviewed and skipped from then on.
+    """
+    limiter = TokenBucket(max_rps) if max_rps else None
+    check_concurrency(workers + list_workers)
+    approved = 0
+    skipped = 0
+    throttled = 0
+    failed = 0
+    start = time.monotonic()
+
+    with session_scope() as session, ThreadPoolExecutor(max_workers=workers) as executor:
+        hits = {
+            hit.hit_id: hit.key
+            for hit in select_hits(session, hit_type_short_names, datasets, [ACTIVE, EXPIRED])
+        }
+        logger.info('Accepting the submitted assignments of %i HITs', len(hits))
+        # Assignments approved by a previous (possibly crashed) run are skipped without an API call.
+        checkpoint = {x for x, in session.query(ApprovedAssignment.assignment_id)}
+        logger.info('Loaded %i checkpointed approvals', len(checkpoint))
+        pending = {}
+        # HIT id -> whether the HIT can still receive assignments, and HITs with failed approvals.
+        states = {}
+        unfinished = set()
+        approvals = []
 
+        def commit():
+            # The checkpoint and the stored assignments' statuses are updated together.
+            if approvals:
+                session.execute(_approve, approvals)
+                approvals.clear()
+            session.commit()
 
+        def drain(return_when):
+            nonlocal approved, throttled, failed
+            done, _ = wait(pending, return_when=return_when)
+            for future in done:
+                assignment_id, hit_id = pending.pop(future)
+                try:
+                    response = future.result()
+                except Exception as e:
+                    if limiter is None and is_throttling_error(e):
+                        throttled += 1
+                    failed += 1
+                    unfinished.add(hit_id)
+                    logger.error('Failed to approve assignment %s: %s', assignment_id, e)
+                    continue
+                logger.debug('Response: %s', response)
+                session.add(ApprovedAssignment(assignment_id=assignment_id))
+                approvals.append({'approved_id': assignment_id, 'approved_at': utcnow()})
+                checkpoint.add(assignment_id)
+                approved += 1
+                if approved % commit_every == 0:
+                    commit()
 
+        # Listing runs on its own pool of threads, feeding the approvers as assignments arrive.
+        assignments = submitted_assignments(
+            hits_to_review(list(hits), states, workers=list_workers, limiter=limiter),
+            workers=list_workers
+        )
+        try:
+            for assignment in assignments:
+                assignment_id = assignment['AssignmentId']
+                if assignment_id in checkpoint:
+                    skipped += 1
+                    continue
+                if dry_run:
+                    logger.info('Would approve assignment %s', assignment_id)
+                    unfinished.add(assignment['HITId'])
+                    continue
+                logger.info(f'Approving assignment: {assignment_id}')
+                future = executor.submit(
+                    call_with_backoff,
+                    limiter,
+                    client_for(limiter).approve_assignment,
+                    AssignmentId=assignment_id
+                )
+                pending[future] = (assignment_id, assignment['HITId'])
+                if len(pending) >= 2 * workers:
+                    drain(FIRST_COMPLETED)
+        finally:
+            # Make sure everything that was approved gets checkpointed, even if listing failed.
+            while pending:
+                drain(FIRST_COMPLETED)
+            commit()
 
+        # Only reached if every HIT was listed in full.
+        reviewed = [hits[hit_id] for hit_id, finished in states.items() if finished and hit_id not in unfinished]
+        if not dry_run:
+            for keys in batched(reviewed, 500):
+                (
+                    session.query(Hit)
+                           .filter(Hit.key.in_(keys))
+                           .update({Hit.status: REVIEWED}, synchronize_session=False)
+                )
+        logger.info('%s %i HITs as reviewed', 'Would mark' if dry_run else 'Marked', len(reviewed))
 
+    elapsed = time.monotonic() - start
+    if limiter is not None:
+        throttled += limiter.throttle_count
+    logger.info(
+        'Approved %i assignments in %.1fs (%.2f approvals/sec); skipped %i, failed %i, throttled %i times',
+        approved,
+        elapsed,
+        approved / elapsed if elapsed else 0.0,
+        skipped,
+        failed,
+        throttled
+    )
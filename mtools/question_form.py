@@ -46,3 +46,80 @@ class QuestionForm:
 
     def tostring(self):
         return xml.tostring(self.etree.getroot(), encoding='unicode')
+
+
+# Largest Question payload accepted by CreateHIT / CreateHITWithHITType.
+MAX_QUESTION_BYTES = 131072
+
+_OPEN = f'<QuestionForm xmlns="{DEFAULT_NAMESPACE}">'
+_CLOSE = '</QuestionForm>'
+_EMPTY = f'<QuestionForm xmlns="{DEFAULT_NAMESPACE}" />'
+_QUESTION_BODY = (
+    '<IsRequired>true</IsRequired>'
+    '<QuestionContent><Text>Choose one:</Text></QuestionContent>'
+    '<AnswerSpecification><SelectionAnswer><StyleSuggestion>radiobutton</StyleSuggestion>'
+)
+_QUESTION_TAIL = '</SelectionAnswer></AnswerSpecification></Question>'
+
+
+def _escape(text):
+    # Matches ElementTree's escaping of element text.
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    return text
+
+
+def _element(tag, text):
+    # ElementTree writes childless elements without text as self-closing tags.
+    if not text:
+        return f'<{tag} />'
+    return f'<{tag}>{_escape(text)}</{tag}>'
+
+
+class TemplateQuestionForm:
+    """
+    A drop-in replacement for `QuestionForm` that renders from string templates.
+
+    The invariant parts of the form are serialized once at import time, so rendering only has to
+    escape and join the identifiers and choice text. Output is identical to `QuestionForm.tostring`.
+    """
+    def __init__(self):
+        self.parts = []
+
+    def add_overview(self, title, text):
+        self.parts.append(f'<Overview>{_element("Title", title)}{_element("Text", text)}</Overview>')
+
+    def add_multiple_choice_question(self, question_identifier, choices):
+        parts = ['<Question>', _element('QuestionIdentifier', question_identifier), _QUESTION_BODY]
+        if choices:
+            parts.append('<Selections>')
+            for i, choice in enumerate(choices):
+                parts.append('<Selection><SelectionIdentifier>')
+                parts.append(string.ascii_lowercase[i])
+                parts.append('</SelectionIdentifier>')
+                parts.append(_element('Text', choice))
+                parts.append('</Selection>')
+            parts.append('</Selections>')
+        else:
+            parts.append('<Selections />')
+        parts.append(_QUESTION_TAIL)
+        self.parts.append(''.join(parts))
+
+    def tostring(self):
+        if not self.parts:
+            return _EMPTY
+        return _OPEN + ''.join(self.parts) + _CLOSE
+
+
+def check_question_size(question_xml):
+    """
+    Raises a ValueError if a rendered question form is too large to send to MTurk.
+    """
+    size = len(question_xml.encode('utf-8'))
+    if size > MAX_QUESTION_BYTES:
+        raise ValueError(f'Question payload is {size} bytes, over the {MAX_QUESTION_BYTES} byte limit')
+    return size
@@ -0,0 +1,244 @@
+"""
+Agreement-driven scheduling of additional assignments.
+
+Launch HITs with few assignments (e.g. `deploy --max_assignments 2`), then let `schedule-assignments`
+buy more only for the HITs whose questions workers still disagree on.
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import logging
+import time
+
+import click
+from sqlalchemy import Integer, cast, func
+
+from mtools.client import check_concurrency, client_for
+from mtools.db import session_scope, utcnow
+from mtools.db import Answer, Assignment, Hit, HitType, Question
+from mtools.journal import is_duplicate_request_error
+from mtools.lifecycle import ACTIVE, REVIEWED
+from mtools.sync import sync_hit_type
+from mtools.throttle import TokenBucket, call_with_backoff
+
+
+logger = logging.getLogger(__name__)
+
+
+# MTurk won't extend a HIT created with fewer than 10 assignments to 10 or more.
+MAX_SMALL_HIT_ASSIGNMENTS = 9
+
+
+def question_votes(session, hit_type):
+    """
+    Yields (hit key, question key, answers, answers picking 'a') for every answered question of a
+    HIT type, counting the answers of assignments that weren't rejected.
+    """
+    rows = (
+        session.query(
+            Question.hit_key,
+            Answer.question_key,
+            func.count(Answer.key),
+            func.sum(cast(Answer.selection == 'a', Integer))
+        )
+        .join(Question, Answer.question_key == Question.key)
+        .join(Assignment, Answer.assignment_key == Assignment.key)
+        .join(Hit, Question.hit_key == Hit.key)
+        .filter(Hit.hit_type_key == hit_type.key)
+        .filter(Assignment.status != 'Rejected')
+        .group_by(Question.hit_key, Answer.question_key)
+    )
+    return rows
+
+
+def is_ambiguous(answers, votes_a, min_answers, min_agreement):
+    """Whether too few workers have answered a question, or too few of them agree."""
+    if answers < min_answers:
+        return True
+    return max(votes_a, answers - votes_a) / answers < min_agreement
+
+
+def collected_hits(session, hit_type):
+    """
+    HITs of a HIT type whose assignments have all been collected, with their number of questions.
+    """
+    stored = (
+        session.query(Assignment.hit_key, func.count(Assignment.key).label('count'))
+               .group_by(Assignment.hit_key)
+               .subquery()
+    )
+    questions = (
+        session.query(Question.hit_key, func.count(Question.key).label('count'))
+               .group_by(Question.hit_key)
+               .subquery()
+    )
+    rows = (
+        session.query(Hit, questions.c.count)
+               .join(stored, stored.c.hit_key == Hit.key)
+               .join(questions, questions.c.hit_key == Hit.key)
+               .filter(Hit.hit_type_key == hit_type.key)
+               .filter(stored.c.count >= Hit.max_assignments)
+    )
+    return rows.all()
+
+
+def waiting_hits(session, hit_type):
+    """
+    HITs of a HIT type that are still missing assignments and can still receive them: active, and
+    not yet expired.
+    """
+    stored = (
+        session.query(Assignment.hit_key, func.count(Assignment.key).label('count'))
+               .group_by(Assignment.hit_key)
+               .subquery()
+    )
+    rows = (
+        session.query(Hit)
+               .outerjoin(stored, stored.c.hit_key == Hit.key)
+               .filter(Hit.hit_type_key == hit_type.key)
+               .filter(Hit.status == ACTIVE)
+               .filter((Hit.expiration == None) | (Hit.expiration > utcnow()))
+               .filter(func.coalesce(stored.c.count, 0) < Hit.max_assignments)
+    )
+    return rows.all()
+
+
+def assignment_cap(hit, max_assignments):
+    """The most assignments `hit` may be extended to."""
+    if hit.max_assignments <= MAX_SMALL_HIT_ASSIGNMENTS:
+        return min(max_assignments, MAX_SMALL_HIT_ASSIGNMENTS)
+    return max_assignments
+
+
+def hits_to_extend(session, hit_type, max_assignments, step=1, min_answers=2, min_agreement=0.66,
+                   min_ambiguous=1):
+    """
+    Picks the fully collected HITs that have at least `min_ambiguous` ambiguous questions and can
+    still be extended. Returns (hit, number of additional assignments) pairs.
+    """
+    ambiguous = {}
+    answered = {}
+    for hit_key, _, answers, votes_a in question_votes(session, hit_type):
+        answered[hit_key] = answered.get(hit_key, 0) + 1
+        if is_ambiguous(answers, votes_a or 0, min_answers, min_agreement):
+            ambiguous[hit_key] = ambiguous.get(hit_key, 0) + 1
+
+    extensions = []
+    for hit, num_questions in collected_hits(session, hit_type):
+        # Questions nobody answered (e.g. all assignments rejected) are ambiguous too.
+        num_ambiguous = ambiguous.get(hit.key, 0) + num_questions - answered.get(hit.key, 0)
+        if num_ambiguous < min_ambiguous:
+            continue
+        additional = min(step, assignment_cap(hit, max_assignments) - hit.max_assignments)
+        if additional > 0:
+            extensions.append((hit, additional))
+    return extensions
+
+
+def extension_token(hit_id, total):
+    """
+    A UniqueRequestToken for extending a HIT to `total` assignments, so that retrying an extension
+    that may already have gone through can't extend the HIT twice.
+    """
+    return f'mtools-extend-{hit_id}-{total}'
+
+
+def extend_hits(session, extensions, workers=8, max_rps=None):
+    """
+    Creates the additional assignments and records the HITs' new number of assignments. Returns
+    the number of HITs extended.
+    """
+    limiter = TokenBucket(max_rps) if max_rps else None
+    check_concurrency(workers)
+
+    def extend(hit_id, additional, total):
+        try:
+            call_with_backoff(
+                limiter,
+                client_for(limiter).create_additional_assignments_for_hit,
+                HITId=hit_id,
+                NumberOfAdditionalAssignments=additional,
+                UniqueRequestToken=extension_token(hit_id, total)
+            )
+        except Exception as e:
+            if not is_duplicate_request_error(e):
+                raise
+            logger.info('HIT %s was already extended to %i assignments', hit_id, total)
+
+    extended = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(extend, hit.hit_id, additional, hit.max_assignments + additional): (hit, additional)
+            for hit, additional in extensions
+        }
+        for future in as_completed(futures):
+            hit, additional = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                logger.error('Failed to extend HIT %s: %s', hit.hit_id, e)
+                continue
+            hit.max_assignments += additional
+            if hit.status == REVIEWED:
+                # The new assignments will need approving.
+                hit.status = ACTIVE
+            extended += 1
+    session.commit()
+    return extended
+
+
+@click.command()
+@click.argument('hit_type_short_name')
+@click.option('--max-assignments', type=int, default=5, help='Never extend a HIT beyond this many assignments.')
+@click.option('--step', type=int, default=1, help='Assignments to add to an ambiguous HIT per round.')
+@click.option('--min-answers', type=int, default=2, help='Questions with fewer answers are ambiguous.')
+@click.option('--min-agreement', type=float, default=0.66,
+              help='Questions whose majority answer has a smaller share are ambiguous.')
+@click.option('--min-ambiguous', type=int, default=1,
+              help='Extend HITs with at least this many ambiguous questions.')
+@click.option('--sync/--no-sync', 'sync', default=True, help='Download new assignments before each round.')
+@click.option('--watch', type=float, default=None,
+              help='Keep running rounds this many seconds apart until no HIT can receive or be given more '
+                   'assignments.')
+@click.option('--dry-run', is_flag=True, default=False, help='Only report which HITs would be extended.')
+@click.option('-w', '--workers', type=int, default=8, help='Number of concurrent API calls.')
+@click.option('--max-rps', type=float, default=None, help='Shared limit on extension calls per second.')
+def schedule_assignments(hit_type_short_name, max_assignments, step, min_answers, min_agreement, min_ambiguous,
+                         sync, watch, dry_run, workers, max_rps):
+    """
+    Adds assignments to fully collected HITs whose questions are still ambiguous.
+
+    HITs must not have expired for their additional assignments to be worked on.
+    """
+    with session_scope() as session:
+        hit_type = (
+            session.query(HitType)
+                   .filter(HitType.short_name == hit_type_short_name)
+                   .one()
+        )
+        while True:
+            if sync:
+                sync_hit_type(session, hit_type, workers=workers)
+            extensions = hits_to_extend(
+                session,
+                hit_type,
+                max_assignments,
+                step=step,
+                min_answers=min_answers,
+                min_agreement=min_agreement,
+                min_ambiguous=min_ambiguous
+            )
+            logger.info('%i HITs need more assignments', len(extensions))
+            if dry_run:
+                for hit, additional in extensions:
+                    logger.info('Would add %i assignments to HIT %s', additional, hit.hit_id)
+                break
+            extended = extend_hits(session, extensions, workers=workers, max_rps=max_rps)
+            logger.info('Extended %i HITs', extended)
+
+            if watch is None:
+                break
+            # HITs that expire before collecting all their assignments would otherwise be waited on
+            # forever.
+            if not extended and not waiting_hits(session, hit_type):
+                logger.info('No HIT is waiting for assignments or needs more')
+                break
+            time.sleep(watch)
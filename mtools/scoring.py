@@ -0,0 +1,264 @@
+"""
+Vectorized scoring of worker responses.
+
+Responses are held as a sparse worker x question matrix in coordinate form: one entry per answer,
+with parallel arrays of worker, question and selected label indices.
+"""
+import csv
+import json
+import math
+import os
+import string
+
+import numpy as np
+
+
+class Responses:
+    """
+    Accumulates (worker, question, selection) responses and their answer key.
+
+    Call `freeze` once every response has been added to get the index arrays used for scoring.
+    """
+    def __init__(self, answer_key, labels=string.ascii_lowercase[:2]):
+        self.answer_key = answer_key
+        self.labels = list(labels)
+        self._label_index = {label: i for i, label in enumerate(self.labels)}
+        self.workers = []
+        self.questions = []
+        self.datasets = []
+        self._worker_index = {}
+        self._question_index = {}
+        self._dataset_index = {}
+        self._worker = []
+        self._question = []
+        self._label = []
+        self._gold = []
+        self._question_dataset = []
+
+    def _index(self, index, values, value):
+        i = index.get(value)
+        if i is None:
+            i = index[value] = len(values)
+            values.append(value)
+        return i
+
+    def add(self, worker_id, question_key, selection):
+        label = self._label_index.get(selection)
+        if label is None:
+            return
+        question = self._question_index.get(question_key)
+        if question is None:
+            answer, dataset = self.answer_key[question_key]
+            question = self._index(self._question_index, self.questions, question_key)
+            self._gold.append(self._label_index[answer])
+            self._question_dataset.append(self._index(self._dataset_index, self.datasets, dataset))
+        self._worker.append(self._index(self._worker_index, self.workers, worker_id))
+        self._question.append(question)
+        self._label.append(label)
+
+    def freeze(self):
+        self.worker = np.asarray(self._worker, dtype=np.int64)
+        self.question = np.asarray(self._question, dtype=np.int64)
+        self.label = np.asarray(self._label, dtype=np.int64)
+        self.gold = np.asarray(self._gold, dtype=np.int64)
+        self.question_dataset = np.asarray(self._question_dataset, dtype=np.int64)
+        self.dataset = self.question_dataset[self.question]
+        self.correct = (self.label == self.gold[self.question]).astype(np.float64)
+        return self
+
+    def __len__(self):
+        return len(self._label)
+
+
+# Inverse CDF of Poisson(1) sampled at 2^16 evenly spaced points. Indexing it with uniform 16-bit
+# integers draws Poisson(1) weights about ten times faster than `Generator.poisson`.
+_POISSON_TABLE = np.searchsorted(
+    np.cumsum([math.exp(-1) / math.factorial(k) for k in range(16)]),
+    (np.arange(2 ** 16) + 0.5) / 2 ** 16
+).astype(np.float64)
+
+
+def _percentiles(replicates, quantiles):
+    # Like np.nanpercentile along axis 0 (nearest-rank), but vectorized over every column; sort
+    # places NaNs last, so only the first `valid` rows of each column count.
+    ordered = np.sort(replicates, axis=0)
+    valid = (~np.isnan(replicates)).sum(axis=0)
+    results = []
+    for q in quantiles:
+        rank = np.clip(np.round(q * (valid - 1)).astype(np.int64), 0, None)
+        values = np.take_along_axis(ordered, rank[None, :], axis=0)[0]
+        results.append(np.where(valid > 0, values, np.nan))
+    return results
+
+
+def grouped_accuracy(groupings, correct, num_bootstrap=200, alpha=0.05, seed=0):
+    """
+    Accuracy per group for several groupings of the same responses, with percentile confidence
+    intervals from a Poisson bootstrap.
+
+    `groupings` is a list of (group index per response, number of groups) pairs. Each bootstrap
+    replicate reweights every response by a Poisson(1) draw, which approximates resampling with
+    replacement and lets every grouping be scored from the same weights with a `bincount`.
+    Returns a list of (counts, accuracy, lower, upper) arrays, one per grouping.
+    """
+    rng = np.random.default_rng(seed)
+    replicates = [np.empty((num_bootstrap, num_groups)) for _, num_groups in groupings]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for b in range(num_bootstrap):
+            weights = _POISSON_TABLE[rng.integers(0, 2 ** 16, size=len(correct), dtype=np.uint16)]
+            weighted = weights * correct
+            for (groups, num_groups), replicate in zip(groupings, replicates):
+                hits = np.bincount(groups, weights=weighted, minlength=num_groups)
+                replicate[b] = hits / np.bincount(groups, weights=weights, minlength=num_groups)
+
+        results = []
+        for (groups, num_groups), replicate in zip(groupings, replicates):
+            counts = np.bincount(groups, minlength=num_groups)
+            accuracy = np.bincount(groups, weights=correct, minlength=num_groups) / counts
+            if num_bootstrap:
+                lower, upper = _percentiles(replicate, [alpha / 2, 1 - alpha / 2])
+            else:
+                lower = upper = np.full(num_groups, np.nan)
+            results.append((counts, accuracy, lower, upper))
+    return results
+
+
+def label_counts(responses):
+    """Question x label matrix of how often each label was selected."""
+    num_questions = len(responses.questions)
+    num_labels = len(responses.labels)
+    flat = np.bincount(
+        responses.question * num_labels + responses.label,
+        minlength=num_questions * num_labels
+    )
+    return flat.reshape(num_questions, num_labels)
+
+
+def majority_vote(responses):
+    """
+    Majority-vote label per question, with the fraction of responses that agree with it.
+
+    Ties are reported as -1.
+    """
+    counts = label_counts(responses)
+    top = counts.max(axis=1)
+    labels = counts.argmax(axis=1)
+    labels[(counts == top[:, None]).sum(axis=1) > 1] = -1
+    agreement = top / np.maximum(counts.sum(axis=1), 1)
+    return labels, agreement
+
+
+def dawid_skene(responses, max_iterations=50, tolerance=1e-6, smoothing=0.01):
+    """
+    Dawid-Skene EM estimates of each question's true label and each worker's confusion matrix.
+
+    Returns the posterior over labels for every question (questions x labels) and every worker's
+    confusion matrix (workers x true label x selected label).
+    """
+    num_workers = len(responses.workers)
+    num_questions = len(responses.questions)
+    num_labels = len(responses.labels)
+    worker, question, label = responses.worker, responses.question, responses.label
+
+    # Initialize from the (soft) majority vote.
+    counts = label_counts(responses).astype(np.float64) + smoothing
+    posterior = counts / counts.sum(axis=1, keepdims=True)
+    confusion = np.empty((num_workers, num_labels, num_labels))
+    if num_questions == 0:
+        return posterior, confusion
+    for _ in range(max_iterations):
+        # M-step: class priors and worker confusion matrices from the current posterior.
+        priors = posterior.mean(axis=0)
+        for true_label in range(num_labels):
+            confusion[:, true_label, :] = np.bincount(
+                worker * num_labels + label,
+                weights=posterior[question, true_label],
+                minlength=num_workers * num_labels
+            ).reshape(num_workers, num_labels)
+        confusion += smoothing
+        confusion /= confusion.sum(axis=2, keepdims=True)
+
+        # E-step: posterior over each question's true label given every worker's response.
+        log_confusion = np.log(confusion)
+        log_posterior = np.tile(np.log(priors), (num_questions, 1))
+        for true_label in range(num_labels):
+            log_posterior[:, true_label] += np.bincount(
+                question,
+                weights=log_confusion[worker, true_label, label],
+                minlength=num_questions
+            )
+        log_posterior -= log_posterior.max(axis=1, keepdims=True)
+        updated = np.exp(log_posterior)
+        updated /= updated.sum(axis=1, keepdims=True)
+        change = np.abs(updated - posterior).max()
+        posterior = updated
+        if change < tolerance:
+            break
+    return posterior, confusion
+
+
+def score(responses, num_bootstrap=200, seed=0):
+    """
+    Scores frozen responses, returning a dict of tables (lists of row dicts) keyed by name.
+    """
+    tables = {}
+    groupings = (
+        ('datasets', responses.dataset, responses.datasets),
+        ('workers', responses.worker, responses.workers),
+        ('questions', responses.question, responses.questions),
+    )
+    results = grouped_accuracy(
+        [(groups, len(keys)) for _, groups, keys in groupings],
+        responses.correct,
+        num_bootstrap=num_bootstrap,
+        seed=seed
+    )
+    for (name, _, keys), (counts, accuracy, lower, upper) in zip(groupings, results):
+        tables[name] = [
+            {
+                name[:-1]: key,
+                'responses': int(counts[i]),
+                'accuracy': float(accuracy[i]),
+                'ci_lower': float(lower[i]),
+                'ci_upper': float(upper[i]),
+            }
+            for i, key in enumerate(keys)
+        ]
+
+    majority, agreement = majority_vote(responses)
+    posterior, confusion = dawid_skene(responses)
+    for i, row in enumerate(tables['questions']):
+        row['dataset'] = responses.datasets[responses.question_dataset[i]]
+        row['gold'] = responses.labels[responses.gold[i]]
+        row['majority'] = responses.labels[majority[i]] if majority[i] >= 0 else ''
+        row['agreement'] = float(agreement[i])
+        row['dawid_skene'] = responses.labels[posterior[i].argmax()]
+        row['dawid_skene_confidence'] = float(posterior[i].max())
+
+    # A worker's estimated accuracy is the diagonal of their confusion matrix, weighted by how
+    # often each label is the true one.
+    priors = posterior.mean(axis=0) if len(posterior) else np.zeros(len(responses.labels))
+    estimated = (np.diagonal(confusion, axis1=1, axis2=2) * priors).sum(axis=1)
+    for i, row in enumerate(tables['workers']):
+        row['dawid_skene_accuracy'] = float(estimated[i])
+        row['confusion'] = confusion[i].round(4).tolist()
+    return tables
+
+
+def write_tables(tables, output_dir, format='csv'):
+    """
+    Writes each table to `output_dir` as `<name>.csv` or `<name>.json`.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    for name, rows in tables.items():
+        filename = os.path.join(output_dir, f'{name}.{format}')
+        with open(filename, 'w', newline='') as f:
+            if format == 'json':
+                json.dump(rows, f, indent=2)
+            elif rows:
+                writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+                writer.writeheader()
+                for row in rows:
+                    writer.writerow({
+                        k: json.dumps(v) if isinstance(v, list) else v for k, v in row.items()
+                    })
@@ -0,0 +1,156 @@
+"""
+Utilities and commands for keeping a local copy of assignments and their answers.
+"""
+import logging
+
+import click
+from sqlalchemy import func
+
+from mtools.client import check_concurrency, client
+from mtools.db import bulk_insert, naive_utc, session_scope
+from mtools.db import Answer, Assignment, Hit, HitType
+from mtools.evaluate import parse_answers, submitted_assignments
+from mtools.lifecycle import DELETED, REVIEWED
+
+
+logger = logging.getLogger(__name__)
+
+
+ALL_STATUSES = ('Submitted', 'Approved', 'Rejected')
+
+
+def uncollected_hits(session, hit_type):
+    """
+    HITs of a HIT type whose stored assignments may be incomplete or out of date: those with fewer
+    stored assignments than they were launched with, and those not yet reviewed, whose assignments
+    can still be approved or rejected. Deleted HITs can no longer be listed.
+    """
+    stored = (
+        session.query(Assignment.hit_key, func.count(Assignment.key).label('count'))
+               .group_by(Assignment.hit_key)
+               .subquery()
+    )
+    incomplete = (Hit.max_assignments == None) | (func.coalesce(stored.c.count, 0) < Hit.max_assignments)
+    hits = (
+        session.query(Hit)
+               .outerjoin(stored, stored.c.hit_key == Hit.key)
+               .filter(Hit.hit_type_key == hit_type.key)
+               .filter(Hit.status != DELETED)
+               .filter(incomplete | (Hit.status != REVIEWED))
+               .all()
+    )
+    return hits
+
+
+def stored_statuses(session, hit_type):
+    """
+    Maps the id of every stored assignment of a HIT type to its status.
+    """
+    rows = (
+        session.query(Assignment.assignment_id, Assignment.status)
+               .join(Hit, Assignment.hit_key == Hit.key)
+               .filter(Hit.hit_type_key == hit_type.key)
+    )
+    return dict(rows)
+
+
+def parse_assignment(hit_key, assignment):
+    """
+    Creates an Assignment from a list_assignments_for_hit result, and parses its (question key,
+    selection) answers.
+    """
+    answers, errors = parse_answers(assignment['Answer'])
+    for error in errors:
+        logger.warning('Assignment %s: %s', assignment['AssignmentId'], error)
+    record = Assignment(
+        hit_key=hit_key,
+        assignment_id=assignment['AssignmentId'],
+        worker_id=assignment['WorkerId'],
+        status=assignment['AssignmentStatus'],
+        accept_time=naive_utc(assignment.get('AcceptTime')),
+        submit_time=naive_utc(assignment.get('SubmitTime')),
+        approval_time=naive_utc(assignment.get('ApprovalTime')),
+    )
+    return record, answers
+
+
+def store_assignments(session, parsed):
+    """
+    Stores parsed assignments: the assignments through the ORM, to get their keys, and their answers
+    in bulk (with COPY on Postgres).
+    """
+    session.add_all(record for record, _ in parsed)
+    session.flush()  # So the keys exist
+    bulk_insert(session, Answer.__table__, [
+        {'assignment_key': record.key, 'question_key': key, 'selection': selection}
+        for record, answers in parsed
+        for key, selection in answers
+    ])
+
+
+def sync_hit_type(session, hit_type, workers=8, commit_every=500):
+    """
+    Downloads new assignments, and status changes, for the HITs of a HIT type that are not yet
+    fully collected or reviewed (see `uncollected_hits`). Returns the numbers of added and updated assignments.
+    """
+    hits = uncollected_hits(session, hit_type)
+    logger.info('Syncing assignments for %i HITs w/ type "%s"', len(hits), hit_type.short_name)
+
+    # HITs deployed before max_assignments was tracked; look it up once so they can be marked
+    # as fully collected in future.
+    for hit in hits:
+        if hit.max_assignments is None:
+            response = client.get_hit(HITId=hit.hit_id)
+            hit.max_assignments = response['HIT']['MaxAssignments']
+    session.commit()
+
+    check_concurrency(workers)
+    statuses = stored_statuses(session, hit_type)
+    # Keys rather than objects, since committing expires the objects.
+    hit_keys = {hit.hit_id: hit.key for hit in hits}
+    parsed = []
+    added = 0
+    updated = 0
+    for assignment in submitted_assignments(hit_keys, statuses=ALL_STATUSES, workers=workers):
+        assignment_id = assignment['AssignmentId']
+        status = assignment['AssignmentStatus']
+        if assignment_id not in statuses:
+            parsed.append(parse_assignment(hit_keys[assignment['HITId']], assignment))
+            added += 1
+            if len(parsed) >= commit_every:
+                store_assignments(session, parsed)
+                session.commit()
+                parsed = []
+        elif statuses[assignment_id] != status:
+            changes = {
+                Assignment.status: status,
+                Assignment.approval_time: naive_utc(assignment.get('ApprovalTime')),
+            }
+            (
+                session.query(Assignment)
+                       .filter(Assignment.assignment_id == assignment_id)
+                       .update(changes, synchronize_session=False)
+            )
+            updated += 1
+        statuses[assignment_id] = status
+    if parsed:
+        store_assignments(session, parsed)
+    session.commit()
+    return added, updated
+
+
+@click.command()
+@click.argument('hit_type_short_name')
+@click.option('-w', '--workers', type=int, default=8, help='Number of concurrent list_assignments_for_hit calls.')
+@click.option('--commit-every', type=int, default=500, help='Commit to the DB after this many new assignments.')
+def sync_assignments(hit_type_short_name, workers, commit_every):
+    """Download new assignments, and status changes, for HITs that are not yet fully collected or reviewed."""
+    with session_scope() as session:
+        hit_type = (
+            session.query(HitType)
+                   .filter(HitType.short_name == hit_type_short_name)
+                   .one()
+        )
+        added, updated = sync_hit_type(session, hit_type, workers=workers, commit_every=commit_every)
+
+    logger.info('Stored %i new assignments, updated the status of %i', added, updated)
@@ -0,0 +1,108 @@
+"""
+Rate limiting for fanning out MTurk API calls over a pool of workers.
+"""
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+THROTTLING_ERROR_CODES = {
+    'Throttling',
+    'ThrottlingException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded',
+}
+
+
+def is_throttling_error(exc):
+    """Whether an exception raised by the client means MTurk throttled us."""
+    # Duck-typed on botocore's ClientError, so that importing this module doesn't load botocore.
+    return is_throttling_response(getattr(exc, 'response', None))
+
+
+def is_throttling_response(response):
+    """Whether a parsed API response is an error saying MTurk throttled us."""
+    if not isinstance(response, dict):
+        return False
+    error = response.get('Error', {})
+    if error.get('Code') in THROTTLING_ERROR_CODES:
+        return True
+    # MTurk reports some rate limiting as a generic ServiceFault / RequestError.
+    message = error.get('Message', '').lower()
+    return 'rate exceeded' in message or 'throttl' in message
+
+
+class TokenBucket:
+    """
+    A token bucket shared by a pool of worker threads.
+
+    The refill rate backs off multiplicatively each time MTurk throttles a
+    request, and recovers additively back up to `max_rate` on success.
+    """
+    def __init__(self, max_rate, burst=None, min_rate=0.5):
+        self.max_rate = float(max_rate)
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.rate = self.max_rate
+        self.capacity = float(burst) if burst is not None else max(1.0, self.max_rate)
+        self.tokens = self.capacity
+        self.throttle_count = 0
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self):
+        """Block until a token is available."""
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        """Halve the rate and drain the bucket after being throttled."""
+        with self._lock:
+            self.throttle_count += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+        logger.debug('Throttled; backing off to %.2f requests/sec', self.rate)
+
+    def succeeded(self):
+        """Creep the rate back towards the configured maximum."""
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+def call_with_backoff(limiter, fn, max_attempts=10, **kwargs):
+    """
+    Call `fn(**kwargs)` under `limiter`, retrying requests that were throttled.
+
+    `limiter` may be None, in which case calls are neither limited nor retried. Otherwise `fn`
+    should be a method of `client_for(limiter)`, so that botocore doesn't retry throttles first.
+    """
+    if limiter is None:
+        return fn(**kwargs)
+    for attempt in range(max_attempts):
+        limiter.acquire()
+        try:
+            response = fn(**kwargs)
+        except Exception as e:
+            if not is_throttling_error(e):
+                raise
+            limiter.throttled()
+            if attempt == max_attempts - 1:
+                raise
+            time.sleep(min(2 ** attempt, 30) / limiter.max_rate)
+        else:
+            limiter.succeeded()
+            return response
@@ -9,8 +9,14 @@ setup(
         'console_scripts': 'mtools-cli = mtools.cli:cli'
     },
     install_requires=[
-        'boto3>=1.0.0',
+        'boto3>=1.14.0',
         'click>=7.1.1',
+        'numpy>=1.17',
         'sqlalchemy>=1.3.16',
     ],
+    extras_require={
+        'arrow': ['pyarrow>=1.0'],
+        'postgres': ['psycopg2-binary>=2.8'],
+        'yaml': ['pyyaml>=5.1'],
+    },
 )
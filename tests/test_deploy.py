@@ -0,0 +1,27 @@
+import numpy as np
+
+from mtools.db import bulk_insert, session_scope, Dataset, Instance
+from mtools.deploy import random_order
+
+
+def test_random_order_is_uniform_over_small_seeds(db):
+    with session_scope() as session:
+        dataset = Dataset(filename='dataset.jsonl', eval_type='no_context')
+        session.add(dataset)
+        session.flush()
+        bulk_insert(session, Instance.__table__, [
+            {'dataset_key': dataset.key, 'sentence_good': '', 'sentence_bad': ''} for _ in range(10000)
+        ])
+        first = session.query(Instance.key).order_by(Instance.key).first()[0]
+
+        # Samples of 50 keys drawn with seeds 0-199 should spread evenly over the key range.
+        counts = np.zeros(10, dtype=int)
+        for seed in range(200):
+            keys = np.array([
+                key for key, in
+                session.query(Instance.key).order_by(random_order(Instance.key, seed)).limit(50)
+            ])
+            counts += np.bincount((keys - first) * 10 // 10000, minlength=10)
+
+    assert counts.sum() == 10000
+    assert counts.min() > 850 and counts.max() < 1150, counts
@@ -0,0 +1,20 @@
+from botocore.exceptions import ClientError
+import pytest
+
+from mtools.journal import is_duplicate_request_error
+
+
+def error(code, message):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, 'CreateHITWithHITType')
+
+
+@pytest.mark.parametrize('exc, duplicate', [
+    (error('RequestError', 'The UniqueRequestToken mtools-1-2 has already been used.'), True),
+    (error('AWS.MechanicalTurk.DuplicateRequest', 'Duplicate request'), True),
+    (error('RequestError', 'A QualificationType with this name already exists.'), False),
+    (error('RequestError', 'This request has already been made with different parameters.'), False),
+    (error('ThrottlingException', 'Rate exceeded'), False),
+    (ValueError('UniqueRequestToken already used'), False),
+])
+def test_is_duplicate_request_error(exc, duplicate):
+    assert is_duplicate_request_error(exc) == duplicate
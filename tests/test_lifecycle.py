@@ -0,0 +1,29 @@
+import datetime
+
+from conftest import prepare_args
+from mtools.db import naive_utc, session_scope, utcnow, Hit
+from mtools.deploy import deploy
+from mtools.lifecycle import EXPIRED, expire_hits
+
+
+def stored_expirations():
+    with session_scope() as session:
+        return [(status, expiration) for status, expiration in session.query(Hit.status, Hit.expiration)]
+
+
+def test_naive_utc():
+    paris = datetime.timezone(datetime.timedelta(hours=2))
+    assert naive_utc(datetime.datetime(2024, 6, 1, 14, 30, tzinfo=paris)) == datetime.datetime(2024, 6, 1, 12, 30)
+    assert naive_utc(datetime.datetime(2024, 6, 1, 14, 30)) == datetime.datetime(2024, 6, 1, 14, 30)
+    assert naive_utc(None) is None
+
+
+def test_expirations_are_stored_as_naive_utc(fake, hit_type, tmp_path):
+    deploy.main(args=prepare_args(tmp_path, 3, '--lifetime_in_seconds', '3600'), standalone_mode=False)
+    expected = utcnow() + datetime.timedelta(hours=1)
+    for _, expiration in stored_expirations():
+        assert expiration.tzinfo is None
+        assert abs(expiration - expected) < datetime.timedelta(minutes=1)
+
+    expire_hits.main(args=['test'], standalone_mode=False)
+    assert stored_expirations() == [(EXPIRED, datetime.datetime(2015, 1, 1))] * 3
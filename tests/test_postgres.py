@@ -0,0 +1,97 @@
+"""
+Postgres-specific paths (COPY, FOR UPDATE SKIP LOCKED), run against the database named by
+MTOOLS_TEST_POSTGRES_URL, which is emptied, and against SQLite as a fallback.
+"""
+import os
+
+import pytest
+
+from mtools.db import bulk_insert, session_scope, Session, Dataset, Instance
+from mtools.deploy import claim_instance_keys, reserve_questions
+
+
+POSTGRES_URL = os.environ.get('MTOOLS_TEST_POSTGRES_URL')
+
+
+@pytest.fixture(params=['sqlite', 'postgresql'])
+def database_url(request, tmp_path):
+    if request.param == 'sqlite':
+        return f'sqlite:///{tmp_path / "mtools.db"}'
+    if not POSTGRES_URL:
+        pytest.skip('Set MTOOLS_TEST_POSTGRES_URL to a throwaway Postgres database')
+    return POSTGRES_URL
+
+
+@pytest.fixture
+def dataset_key(db):
+    with session_scope() as session:
+        dataset = Dataset(filename='dataset.jsonl', eval_type='no_context')
+        session.add(dataset)
+        session.flush()
+        bulk_insert(session, Instance.__table__, [
+            {'dataset_key': dataset.key, 'sentence_good': f'good {i}', 'sentence_bad': f'bad {i}'}
+            for i in range(100)
+        ])
+        return dataset.key
+
+
+def dataset(session, key):
+    return session.query(Dataset).filter(Dataset.key == key).one()
+
+
+def test_bulk_insert_round_trips_escaped_values(db, dataset_key):
+    values = [
+        'tab\there',
+        'new\nline',
+        'carriage\rreturn',
+        'back\\slash',
+        '\\N',
+        'trailing backslash\\',
+        'unicode: café – 中文',
+        '',
+    ]
+    rows = [
+        {'dataset_key': dataset_key, 'sentence_good': value, 'sentence_bad': None, 'content_hash': str(i)}
+        for i, value in enumerate(values)
+    ]
+    with session_scope() as session:
+        bulk_insert(session, Instance.__table__, rows)
+
+    with session_scope() as session:
+        stored = (
+            session.query(Instance.sentence_good, Instance.sentence_bad, Instance.asked)
+                   .filter(Instance.content_hash != None)
+                   .order_by(Instance.key)
+                   .all()
+        )
+    # `asked` was left out, so its column default applies.
+    assert stored == [(value, None, False) for value in values]
+
+
+def test_claims_skip_instances_claimed_by_open_transactions(db, dataset_key):
+    if db.dialect.name == 'sqlite':
+        pytest.skip('SQLite has no row locks')
+    first = Session(bind=db)
+    second = Session(bind=db)
+    try:
+        # The same seed draws the same sample, so the second claim only gets what the first skipped.
+        claimed = claim_instance_keys(first, [dataset(first, dataset_key)], 30, seed=0)
+        other = claim_instance_keys(second, [dataset(second, dataset_key)], 30, seed=0)
+        assert len(claimed) == len(other) == 30
+        assert set(claimed).isdisjoint(other)
+    finally:
+        first.rollback()
+        second.rollback()
+        first.close()
+        second.close()
+
+
+def test_claims_skip_instances_reserved_by_committed_transactions(db, dataset_key):
+    claimed = []
+    for _ in range(3):
+        with session_scope() as session:
+            keys = claim_instance_keys(session, [dataset(session, dataset_key)], 30, seed=0)
+            reserve_questions(session, keys)
+        claimed.append(set(keys))
+    assert [len(keys) for keys in claimed] == [30, 30, 30]
+    assert len(set.union(*claimed)) == 90
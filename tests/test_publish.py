@@ -0,0 +1,89 @@
+import itertools
+
+from botocore.exceptions import ClientError
+import pytest
+from sqlalchemy import func
+
+from conftest import prepare_args
+from mtools.db import session_scope, Hit, LaunchChunk, Question
+from mtools.deploy import prepare, publish
+from mtools.journal import PENDING, PUBLISHED
+
+
+@pytest.fixture
+def batch(fake, hit_type, tmp_path):
+    prepare.main(args=prepare_args(tmp_path, 20), standalone_mode=False)
+    return str(tmp_path / 'batch.jsonl')
+
+
+def recorded_hits():
+    """HIT id -> keys of the questions it asks, for every recorded HIT."""
+    with session_scope() as session:
+        hits = {}
+        for hit_id, key in session.query(Hit.hit_id, Question.key).join(Question, Question.hit_key == Hit.key):
+            hits.setdefault(hit_id, set()).add(key)
+        return hits
+
+
+def chunk_states():
+    with session_scope() as session:
+        return dict(session.query(LaunchChunk.state, func.count(LaunchChunk.key)).group_by(LaunchChunk.state))
+
+
+def pending_tokens():
+    with session_scope() as session:
+        return {
+            token for token, in
+            session.query(LaunchChunk.unique_request_token).filter(LaunchChunk.state == PENDING)
+        }
+
+
+def test_publish_launches_each_chunk_once(fake, batch):
+    publish.main(args=[batch, '--workers', '4'], standalone_mode=False)
+
+    hits = recorded_hits()
+    assert fake.calls['CreateHITWithHITType'] == 20
+    assert set(hits) == set(fake._hits)
+    assert all(len(keys) == 2 for keys in hits.values())
+    assert len(set.union(*hits.values())) == 40
+    assert chunk_states() == {PUBLISHED: 20}
+
+    publish.main(args=[batch, '--workers', '4'], standalone_mode=False)
+    assert fake.calls['CreateHITWithHITType'] == 20
+
+
+def test_publish_keeps_launches_before_a_failure_and_resumes(fake, batch, monkeypatch):
+    create_hit = fake.create_hit_with_hit_type
+    calls = itertools.count(1)
+    tokens = []
+
+    def unreliable_create_hit(**kwargs):
+        tokens.append(kwargs['UniqueRequestToken'])
+        call = next(calls)
+        if call == 3:
+            # Launched, but the response never arrives.
+            create_hit(**kwargs)
+            raise ClientError({'Error': {'Code': 'ServiceUnavailable', 'Message': ''}}, 'CreateHITWithHITType')
+        if call == 5:
+            raise ClientError({'Error': {'Code': 'ServiceUnavailable', 'Message': ''}}, 'CreateHITWithHITType')
+        return create_hit(**kwargs)
+
+    monkeypatch.setattr(fake, 'create_hit_with_hit_type', unreliable_create_hit)
+    with pytest.raises(ClientError):
+        publish.main(args=[batch, '--workers', '4'], standalone_mode=False)
+
+    states = chunk_states()
+    hits = recorded_hits()
+    assert states[PUBLISHED] == len(hits) >= 3
+    assert states[PUBLISHED] + states[PENDING] == 20
+    assert len(fake._hits) == len(hits) + 1
+    remainder = pending_tokens()
+
+    del tokens[:]
+    publish.main(args=[batch, '--workers', '4'], standalone_mode=False)
+
+    assert sorted(tokens) == sorted(remainder)
+    assert chunk_states() == {PUBLISHED: 20}
+    hits = recorded_hits()
+    assert set(hits) == set(fake._hits)
+    assert len(set.union(*hits.values())) == 40
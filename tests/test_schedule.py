@@ -0,0 +1,24 @@
+import datetime
+import threading
+
+from conftest import prepare_args
+from mtools.db import session_scope, utcnow, Hit
+from mtools.deploy import deploy
+from mtools.schedule import schedule_assignments
+
+
+def test_watch_stops_once_no_hit_can_receive_assignments(fake, hit_type, tmp_path):
+    deploy.main(args=prepare_args(tmp_path, 3, '--max_assignments', '2'), standalone_mode=False)
+    with session_scope() as session:
+        # Extended to 3 assignments, but expired before the third was worked on.
+        hit = session.query(Hit).order_by(Hit.key).first()
+        hit.max_assignments = 3
+        hit.expiration = utcnow() - datetime.timedelta(minutes=1)
+
+    args = ['test', '--watch', '0.01', '--min-ambiguous', '100']
+    watcher = threading.Thread(
+        target=schedule_assignments.main, kwargs={'args': args, 'standalone_mode': False}, daemon=True
+    )
+    watcher.start()
+    watcher.join(timeout=10)
+    assert not watcher.is_alive()
@@ -0,0 +1,68 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from conftest import prepare_args
+import mtools.mturk
+from mtools.db import session_scope, Assignment
+from mtools.deploy import deploy
+from mtools.mturk import accept_all, hits_to_review
+from mtools.sync import sync_assignments
+
+
+def stored_statuses():
+    with session_scope() as session:
+        return {
+            assignment_id: (status, approval_time is not None)
+            for assignment_id, status, approval_time in
+            session.query(Assignment.assignment_id, Assignment.status, Assignment.approval_time)
+        }
+
+
+def test_accept_all_marks_stored_assignments_approved(fake, hit_type, tmp_path):
+    deploy.main(args=prepare_args(tmp_path, 5, '--max_assignments', '3'), standalone_mode=False)
+    sync_assignments.main(args=['test'], standalone_mode=False)
+    assert set(stored_statuses().values()) == {('Submitted', False)}
+
+    accept_all.main(args=['test'], standalone_mode=False)
+    statuses = stored_statuses()
+    assert len(statuses) == 15
+    assert set(statuses.values()) == {('Approved', True)}
+
+
+def test_sync_updates_fully_collected_hits_until_reviewed(fake, hit_type, tmp_path):
+    deploy.main(args=prepare_args(tmp_path, 5, '--max_assignments', '3'), standalone_mode=False)
+    sync_assignments.main(args=['test'], standalone_mode=False)
+    approved = sorted(stored_statuses())[:4]
+    for assignment_id in approved:
+        fake.approve_assignment(AssignmentId=assignment_id)
+
+    sync_assignments.main(args=['test'], standalone_mode=False)
+    statuses = stored_statuses()
+    assert {statuses[assignment_id] for assignment_id in approved} == {('Approved', True)}
+    assert sum(status == ('Submitted', False) for status in statuses.values()) == 11
+
+
+def test_hits_to_review_keeps_few_lookups_in_flight(fake, monkeypatch):
+    submitted = []
+    peak = 0
+
+    class Executor(ThreadPoolExecutor):
+        def submit(self, *args, **kwargs):
+            nonlocal peak
+            future = super().submit(*args, **kwargs)
+            submitted.append(future)
+            peak = max(peak, sum(not x.done() for x in submitted))
+            return future
+
+    monkeypatch.setattr(mtools.mturk, 'ThreadPoolExecutor', Executor)
+    fake.latency = 0.01
+    hit_ids = [
+        fake.create_hit_with_hit_type(
+            HITTypeId='FAKEHITTYPE', MaxAssignments=1, LifetimeInSeconds=3600, Question=''
+        )['HIT']['HITId']
+        for _ in range(50)
+    ]
+    states = {}
+
+    assert sorted(hits_to_review(hit_ids, states, workers=2)) == sorted(hit_ids)
+    assert set(states) == set(hit_ids)
+    assert peak <= 4
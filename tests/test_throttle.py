@@ -0,0 +1,47 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from bench_throttling import ThrottlingEndpoint
+from fake_mturk import FakeMTurk
+from mtools.client import client_for, get_client
+from mtools.throttle import TokenBucket, call_with_backoff
+
+
+def test_limited_client_leaves_retries_to_call_with_backoff(config):
+    limiter = TokenBucket(100)
+    endpoint = ThrottlingEndpoint(throttles=3)
+    client = client_for(limiter)
+    client.meta.events.register('before-send.mturk', endpoint)
+
+    response = call_with_backoff(limiter, client.get_account_balance)
+
+    assert response['AvailableBalance'] == '10000.00'
+    assert endpoint.attempts == 4
+    assert limiter.throttle_count == 3
+    assert limiter.rate < limiter.max_rate
+    assert client_for(None) is get_client()
+    assert client is not get_client()
+
+
+def test_limiter_rate_drops_under_sustained_throttling():
+    fake = FakeMTurk(max_rps=10)
+    limiter = TokenBucket(100)
+    rates = []
+
+    def create_hit(i):
+        def call(**kwargs):
+            rates.append(limiter.rate)
+            return fake.create_hit_with_hit_type(**kwargs)
+
+        return call_with_backoff(
+            limiter, call, HITTypeId='FAKEHITTYPE', MaxAssignments=1, LifetimeInSeconds=3600, Question='',
+            UniqueRequestToken=str(i)
+        )
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        responses = list(executor.map(create_hit, range(40)))
+
+    assert len({response['HIT']['HITId'] for response in responses}) == 40
+    throttled = sum(fake.throttled.values())
+    assert throttled > 0
+    assert limiter.throttle_count == throttled
+    assert min(rates) <= 25